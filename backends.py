@@ -0,0 +1,413 @@
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from prompt_context import estimate_tokens, song_message, SYSTEM_MESSAGE
+from rate_limit import make_rate_limiter, backoff_delay, retry_after_seconds, OPENAI_RATE_LIMIT
+from song_json import JsonScanner, SONG_LIST_SCHEMA, parse_songs, candidate_songs
+from replay import Recorder
+from metrics import metrics
+import openai_async
+
+# LLM backends that recommend songs. Every backend takes a prompt and a number of songs and
+# returns the raw reply text (or None), and declares the limits the sweep uses to size its
+# requests: how many requests it handles at once, how many songs one request may ask for,
+# and its context window in tokens. Backends that can return several independent replies
+# (choices) to one request set supports_choices and implement _complete_choices.
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+# Append every reply to this JSON lines file, in the format FixtureBackend replays
+LLM_RECORD_PATH = os.getenv("LLM_RECORD_PATH")
+
+# Constrain replies to song_json.SongList's JSON schema ({"songs": [{title, artist, album}]})
+# through OpenAI's response_format and Ollama's format parameter, instead of asking for JSON in prose
+STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "0") == "1"
+
+# Reply tokens reserved per requested song when fitting a request into the context window
+TOKENS_PER_SONG = 40
+
+# LLM calls made on the current thread, read by the sweep to report calls per combination
+llm_calls = threading.local()
+
+def count_calls(count=1):
+    llm_calls.count = getattr(llm_calls, "count", 0) + count
+
+
+class LLMBackend:
+    name = "base"
+    model = None
+    max_concurrency = 1
+    max_songs_per_request = 20
+    context_window = 4096
+    supports_choices = False
+
+    def __init__(self, structured=None):
+        self.structured = STRUCTURED_OUTPUT if structured is None else structured
+        self.limit = threading.BoundedSemaphore(self.max_concurrency)
+        self.pool = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=self.name)
+        self.recorder = Recorder(LLM_RECORD_PATH) if LLM_RECORD_PATH else None
+
+    # Request num_runs songs for prompt, returning the raw reply or None.
+    def complete(self, prompt, num_runs):
+        count_calls()
+        return self._complete_limited(prompt, num_runs)
+
+    # Run several (prompt, num_runs) requests concurrently, results in request order.
+    def complete_many(self, batch):
+        if len(batch) == 1:
+            return [self.complete(*batch[0])]
+        count_calls(len(batch))
+        futures = [self.pool.submit(self._complete_limited, prompt, num_runs) for prompt, num_runs in batch]
+        return [future.result() for future in futures]
+
+    # Request n independent replies to the same prompt, each of which may be None. Backends
+    # without choices send n requests concurrently instead of one.
+    def complete_choices(self, prompt, num_runs, n):
+        if n == 1 or not self.supports_choices:
+            return self.complete_many([(prompt, num_runs)] * n)
+        count_calls()
+        start = time.perf_counter()
+        with self.limit, metrics.span("llm_complete", backend=self.name):
+            outputs = self._complete_choices(prompt, num_runs, n)
+        self._count_samples(time.perf_counter() - start, n)
+        for choice, output in enumerate(outputs):
+            self._record(prompt, num_runs, output, choice)
+        return outputs
+
+    def _complete_limited(self, prompt, num_runs):
+        start = time.perf_counter()
+        with self.limit, metrics.span("llm_complete", backend=self.name):
+            output = self._complete(prompt, num_runs)
+        self._count_samples(time.perf_counter() - start, 1)
+        self._record(prompt, num_runs, output)
+        return output
+
+    # Latency per reply, so sampling with and without choices can be compared
+    def _count_samples(self, seconds, n):
+        metrics.inc("llm_samples", n, backend=self.name)
+        for _ in range(n):
+            metrics.observe("llm_sample", seconds / n, backend=self.name)
+
+    def _record(self, prompt, num_runs, output, choice=0):
+        if self.recorder and output:
+            key = fixture_key(prompt, num_runs, choice)
+            self.recorder.write(key, {"key": key, "output": output})
+
+    def _complete(self, prompt, num_runs):
+        raise NotImplementedError
+
+    def _complete_choices(self, prompt, num_runs, n):
+        raise NotImplementedError
+
+    # Split a request for `wanted` songs into request sizes that fit this backend.
+    def request_sizes(self, prompt, wanted):
+        room = self.context_window - estimate_tokens(SYSTEM_MESSAGE + song_message(prompt, wanted))
+        per_request = max(1, min(self.max_songs_per_request, room // TOKENS_PER_SONG))
+        if room < TOKENS_PER_SONG:
+            print(f"Warning: prompt is close to the {self.context_window} token context window of {self.name}")
+        count = math.ceil(wanted / per_request)
+        return [wanted // count + (1 if i < wanted % count else 0) for i in range(count)]
+
+
+class OpenAIBackend(LLMBackend):
+    name = "openai"
+    model = os.getenv("OPENAI_MODEL", "gpt-4o")
+    max_concurrency = int(os.getenv("OPENAI_CONCURRENCY", "4"))
+    max_songs_per_request = 50
+    context_window = 128000
+    supports_choices = True
+
+    def __init__(self, client=None, temperature=0.7, structured=None):
+        super().__init__(structured)
+        if client is None:
+            from openai import OpenAI
+            # Retries follow the same rules as the async path, so the SDK's own are disabled
+            client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0)
+        self.client = client
+        self.temperature = temperature
+        self.bucket = make_rate_limiter("openai", OPENAI_RATE_LIMIT)
+
+    def _messages(self, prompt, num_runs):
+        return [{"role": "system", "content": SYSTEM_MESSAGE},
+                {"role": "user", "content": song_message(prompt, num_runs)}]
+
+    # Prompt tokens served from OpenAI's prompt cache are counted as kind="cached" (also part of kind="prompt")
+    def _count_tokens(self, response):
+        usage = getattr(response, "usage", None)
+        if usage:
+            metrics.inc("llm_tokens", usage.prompt_tokens, backend=self.name, kind="prompt")
+            metrics.inc("llm_tokens", usage.completion_tokens, backend=self.name, kind="completion")
+            details = getattr(usage, "prompt_tokens_details", None)
+            metrics.inc("llm_tokens", getattr(details, "cached_tokens", None) or 0, backend=self.name, kind="cached")
+
+    def _response_format(self):
+        if not self.structured:
+            return {}
+        schema = {"name": "song_list", "schema": SONG_LIST_SCHEMA, "strict": True}
+        return {"response_format": {"type": "json_schema", "json_schema": schema}}
+
+    # The reply text of every choice, None for an empty one. The prompt is billed once for all of them.
+    def _outputs(self, response, n):
+        outputs = [choice.message.content for choice in response.choices]
+        outputs = [output if output and output.strip() else None for output in outputs]
+        if not any(outputs):
+            print("GPT Error: Received empty response from GPT")
+        return outputs + [None] * (n - len(outputs))
+
+    def _complete(self, prompt, num_runs):
+        return self._complete_choices(prompt, num_runs, 1)[0]
+
+    def _complete_choices(self, prompt, num_runs, n):
+        if openai_async.USE_ASYNC_OPENAI:
+            return openai_async.run(self.complete_async(prompt, num_runs, n))
+        # Retried on the same errors as openai_async.create_completion
+        for attempt in range(openai_async.RETRIES):
+            self.bucket.acquire()
+            try:
+                response = self.client.chat.completions.create(
+                    messages=self._messages(prompt, num_runs),
+                    model=self.model,
+                    n=n,
+                    temperature=self.temperature,
+                    logprobs=None,
+                    store=False,
+                    **self._response_format()
+                )
+            except openai_async.RETRYABLE_ERRORS as e:
+                # Out of quota is reported as a rate limit but will not recover by waiting
+                if attempt == openai_async.RETRIES - 1 or getattr(e, "code", None) == "insufficient_quota":
+                    print(f"GPT Error: {e}")
+                    break
+                delay = backoff_delay(attempt, retry_after_seconds(e))
+                metrics.inc("llm_retries", backend=self.name)
+                print(f"GPT Error: {e}. Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+                continue
+            except Exception as e:
+                print(f"GPT Error: {e}")
+                break
+            self._count_tokens(response)
+            return self._outputs(response, n)
+        return [None] * n
+
+    # Async variant on the shared AsyncOpenAI client, see openai_async.py
+    async def complete_async(self, prompt, num_runs, n=1):
+        try:
+            response = await openai_async.create_completion(
+                self._messages(prompt, num_runs),
+                model=self.model,
+                temperature=self.temperature,
+                n=n,
+                bucket=self.bucket,
+                concurrency=self.max_concurrency,
+                **self._response_format()
+            )
+        except Exception as e:
+            print(f"GPT Error: {e}")
+            return [None] * n
+        self._count_tokens(response)
+        return self._outputs(response, n)
+
+
+class OllamaBackend(LLMBackend):
+    name = "ollama"
+    model = os.getenv("OLLAMA_MODEL", "deepseek-r1:1.5b")
+    # Matches Ollama's OLLAMA_NUM_PARALLEL, a small local model only copes with short lists
+    max_concurrency = int(os.getenv("OLLAMA_NUM_PARALLEL", "1"))
+    max_songs_per_request = 10
+    context_window = int(os.getenv("OLLAMA_NUM_CTX", "4096"))
+
+    def __init__(self, url=None, keep_alive=None, structured=None):
+        super().__init__(structured)
+        self.url = url or os.getenv("OLLAMA_URL", "http://localhost:11434")
+        self.keep_alive = keep_alive or os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+    def _request(self, prompt, num_runs):
+        request = {
+            'model': self.model,
+            'system': SYSTEM_MESSAGE,
+            'prompt': song_message(prompt, num_runs),
+            'stream': True,
+            'keep_alive': self.keep_alive,
+            "options": {"num_ctx": self.context_window}
+        }
+        if self.structured:
+            request['format'] = SONG_LIST_SCHEMA
+        else:
+            request['prompt'] += "\nOnly JSON format as output, follow this template [{title: '', artist: '', album: ''}]"
+        return request
+
+    def _complete(self, prompt, num_runs):
+        retries = 5
+        for attempt in range(retries):
+            try:
+                # Stream the reply and stop reading as soon as a complete JSON value has arrived
+                with requests.post(
+                    f'{self.url}/api/generate',
+                    headers={'Content-Type': 'application/json'},
+                    data=json.dumps(self._request(prompt, num_runs)),
+                    stream=True,
+                    timeout=(5, 120)
+                ) as response:
+                    if response.status_code != 200:
+                        print(f"\nRequest failed with status code {response.status_code}")
+                        print(f"Response: {response.text}")
+                        return None
+                    output = read_stream(response.iter_lines(), num_runs)
+                if not output.strip():
+                    raise ValueError("Received empty response from Ollama")
+                return output
+            except requests.RequestException as e:
+                delay = backoff_delay(attempt)
+                metrics.inc("llm_retries", backend=self.name)
+                print(f"\nOllama Error: {e}. Retrying in {delay:.1f} seconds...")
+                time.sleep(delay)
+            except Exception as e:
+                print(f"\nOllama Error: {e}")
+                break
+        return None
+
+
+# Replays recorded replies from a JSON lines fixture file, for offline runs and CI.
+# Each line holds {"key": fixture_key(prompt, num_runs, choice), "output": "..."}. Prompts that
+# were not recorded get the recorded replies in turn, so any prompt still gets a plausible answer.
+# latency and error_rate simulate the API: a failed attempt is retried after a backoff, as
+# the OpenAI backend does on a rate limit.
+class FixtureBackend(LLMBackend):
+    name = "fixture"
+    max_concurrency = int(os.getenv("LLM_FIXTURE_CONCURRENCY", "32"))
+    max_songs_per_request = 50
+    context_window = 128000
+    supports_choices = True
+
+    def __init__(self, path=None, latency=None, error_rate=None, seed=None, structured=None):
+        super().__init__(structured)
+        self.path = path or os.getenv("LLM_FIXTURE_PATH", "fixtures/llm.jsonl")
+        self.latency = float(os.getenv("LLM_FIXTURE_LATENCY", "0")) if latency is None else latency
+        self.error_rate = float(os.getenv("LLM_FIXTURE_ERROR_RATE", "0")) if error_rate is None else error_rate
+        self.random = random.Random(seed)
+        self.retries = 0
+        self.replies = {}
+        self.order = []
+        self.next_index = 0
+        self.lock = threading.Lock()
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.replies[entry["key"]] = entry["output"]
+                    self.order.append(entry["output"])
+
+    def _complete(self, prompt, num_runs):
+        return self._complete_choices(prompt, num_runs, 1)[0]
+
+    def _complete_choices(self, prompt, num_runs, n):
+        attempt = 0
+        while True:
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                failed = self.random.random() < self.error_rate
+                if failed:
+                    self.retries += 1
+            if not failed:
+                break
+            time.sleep(backoff_delay(attempt, base=0.05, cap=1.0))
+            attempt += 1
+        outputs = [self.replies.get(fixture_key(prompt, num_runs, choice)) for choice in range(n)]
+        for choice, output in enumerate(outputs):
+            if output is None and self.order:
+                with self.lock:
+                    outputs[choice] = self.order[self.next_index % len(self.order)]
+                    self.next_index += 1
+        return outputs
+
+
+# Replies to one request are told apart by their choice index, the first keeps the plain key
+def fixture_key(prompt, num_runs, choice=0):
+    suffix = f"\n{choice}" if choice else ""
+    return hashlib.sha256(f"{num_runs}\n{prompt}{suffix}".encode()).hexdigest()
+
+BACKENDS = {"openai": OpenAIBackend, "ollama": OllamaBackend, "fixture": FixtureBackend}
+
+def backend_class(name=None):
+    name = name or LLM_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM_BACKEND '{name}', expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]
+
+def make_backend(name=None, **kwargs):
+    return backend_class(name)(**kwargs)
+
+
+# Return the start of the longest suffix of text that could be the start of tag.
+def partial_tag_start(text, tag):
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if tag.startswith(text[-length:]):
+            return len(text) - length
+    return len(text)
+
+# Read an Ollama NDJSON stream token by token. <think> segments are dropped as they arrive,
+# visible text is printed straight away, and reading stops once a complete JSON value has
+# been emitted and the reply so far holds `wanted` songs. A bracketed value without them, such
+# as "[are]" in prose or the first of several separate song objects, does not stop it.
+def read_stream(lines, wanted=1):
+    output = ""
+    pending = ""
+    thinking = False
+    scanner = JsonScanner()
+    # Where in output the current scanner started
+    start = 0
+    for line in lines:
+        if not line:
+            continue
+        try:
+            data = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        pending += data.get('response', '')
+        done = data.get('done', False)
+        visible = ""
+        while pending:
+            tag = '</think>' if thinking else '<think>'
+            index = pending.find(tag)
+            if index == -1:
+                # Hold back anything that may be the first half of a tag split across tokens
+                cut = len(pending) if done else partial_tag_start(pending, tag)
+                if not thinking:
+                    visible += pending[:cut]
+                pending = pending[cut:]
+                break
+            if not thinking:
+                visible += pending[:index]
+            pending = pending[index + len(tag):]
+            thinking = not thinking
+        if visible:
+            fed = len(output)
+            output += visible
+            complete = False
+            while fed < len(output):
+                end = scanner.feed(output[fed:])
+                if end is None:
+                    break
+                end += start
+                if len(candidate_songs(parse_songs(output[:end], verbose=False))) >= wanted:
+                    complete = True
+                    break
+                # Not enough songs yet, scan on from the end of this value
+                scanner = JsonScanner()
+                start = fed = end
+            if complete:
+                visible = visible[:len(visible) - (len(output) - end)]
+                output = output[:end]
+            print(visible, end='', flush=True)
+            if complete:
+                break
+        if done:
+            break
+    print()
+    return output
@@ -0,0 +1,111 @@
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+from metrics import metrics, series_name, timed
+
+# Offline benchmark for the recommendation pipeline. Replays recorded Spotify responses and LLM
+# replies with synthetic latency and errors, runs main.process_csv over them and
+# reports wall time, calls per combination, the track lookup hit ratio and p50/p95 per stage,
+# using the spans and counters from metrics.py.
+#
+# Record the fixtures with one live run:
+#   SPOTIFY_RECORD=fixtures/spotify.jsonl LLM_RECORD_PATH=fixtures/llm.jsonl python main.py
+# Then replay them as often as needed, without credentials:
+#   python benchmark.py --spotify-latency 0.1 --llm-latency 2 --error-rate 0.02
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay recorded API responses through the pipeline and time it.")
+    parser.add_argument("--spotify", default="fixtures/spotify.jsonl", help="recorded Spotify responses (SPOTIFY_RECORD)")
+    parser.add_argument("--llm", default="fixtures/llm.jsonl", help="recorded LLM replies (LLM_RECORD_PATH)")
+    parser.add_argument("--input", default="input.csv", help="prompts CSV, as read by main.py")
+    parser.add_argument("--spotify-latency", type=float, default=0.0, help="seconds added to every Spotify call")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds added to every LLM call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls that fail and are retried")
+    parser.add_argument("--cache", help="track cache to reuse between runs, a fresh one by default")
+    parser.add_argument("--no-rate-limits", action="store_true", help="turn off the client side request rate limits")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the pipeline's own output")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="musicai-bench-")
+    input_file = os.path.abspath(args.input)
+    # Configure replay before the pipeline modules read their settings at import
+    os.environ.update({
+        "SPOTIFY_REPLAY": os.path.abspath(args.spotify),
+        "SPOTIFY_REPLAY_LATENCY": str(args.spotify_latency),
+        "SPOTIFY_REPLAY_ERROR_RATE": str(args.error_rate),
+        "LLM_BACKEND": "fixture",
+        "LLM_FIXTURE_PATH": os.path.abspath(args.llm),
+        "LLM_FIXTURE_LATENCY": str(args.llm_latency),
+        "LLM_FIXTURE_ERROR_RATE": str(args.error_rate),
+        "TRACK_CACHE_PATH": os.path.abspath(args.cache) if args.cache else os.path.join(workdir, "tracks.sqlite"),
+        "USER_PROFILE_PATH": os.path.join(workdir, "user_info.json")
+    })
+    if args.no_rate_limits:
+        os.environ.update({"SPOTIFY_RATE_LIMIT": "0", "OPENAI_RATE_LIMIT": "0"})
+    os.environ.pop("REDIS_URL", None)
+    os.chdir(workdir)
+    os.makedirs("output")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main as pipeline
+
+    sp = pipeline.get_spotify()
+    sp.random.seed(args.seed)
+    backend = pipeline.get_backend()
+    backend.random.seed(args.seed)
+    results = []
+    run_combination = timed("combination")(pipeline.run_combination)
+    def record_combination(prompt, options_dict):
+        result = run_combination(prompt, options_dict)
+        results.append(result)
+        return result
+    pipeline.run_combination = record_combination
+
+    output = sys.stdout if args.verbose else open(os.devnull, 'w')
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        pipeline.process_csv(input_file)
+        metrics.export()
+    wall_time = time.perf_counter() - start
+
+    combinations = len(results) or 1
+    records = metrics.records()
+    spans = [record for record in records if record["type"] == "span"]
+    lookups = sum(record["count"] for record in spans if record["name"] == "check_song_exists")
+    report = {
+        "wall_time": wall_time,
+        "combinations": len(results),
+        "llm_calls_per_combination": sum(result["llm_calls"] for result in results) / combinations,
+        "spotify_searches_per_combination": sp.calls["search"] / combinations,
+        "track_lookups": lookups,
+        "cache_hit_ratio": 1 - sp.calls["search"] / lookups if lookups else 0.0,
+        "retries": {"spotify": sum(sp.retries.values()), "llm": backend.retries},
+        "stages": {
+            series_name(record): {"count": record["count"], "p50": record["p50"], "p95": record["p95"]}
+            for record in spans
+        },
+        "counters": {series_name(record): record["value"] for record in records if record["type"] == "counter"}
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"Wall time: {wall_time:.2f}s")
+    print(f"Combinations: {report['combinations']}, LLM calls per combination: {report['llm_calls_per_combination']:.2f}, "
+          f"Spotify searches per combination: {report['spotify_searches_per_combination']:.2f}")
+    print(f"Track lookups: {lookups}, cache hit ratio: {report['cache_hit_ratio']:.1%}")
+    print(f"Retries: spotify {report['retries']['spotify']}, llm {report['retries']['llm']}")
+    print(f"{'Stage':<32}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<32}{stats['count']:>8}{stats['p50'] * 1000:>10.1f}{stats['p95'] * 1000:>10.1f}")
+    for counter, value in report["counters"].items():
+        print(f"{counter:<32}{value:>8g}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import csv
+import json
+import os
+import threading
+
+# Journal of finished (prompt, option combination) results for main.process_csv. Every result is
+# appended and flushed as soon as its combination finishes, so a run that crashes or is stopped
+# can be restarted and only runs the combinations that are missing. The journal is removed once
+# a run completes.
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", ".checkpoint.jsonl")
+
+
+class Checkpoint:
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line is cut short if the run died while writing it
+                        continue
+                    self.results[entry["key"]] = entry["result"]
+
+    @staticmethod
+    def key(prompt, options_dict):
+        return json.dumps([prompt, options_dict], sort_keys=True)
+
+    def get(self, prompt, options_dict):
+        return self.results.get(self.key(prompt, options_dict))
+
+    def record(self, prompt, options_dict, result):
+        key = self.key(prompt, options_dict)
+        with self.lock:
+            self.results[key] = result
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({"key": key, "result": result}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    # (prompt, result) for every journaled combination.
+    def items(self):
+        with self.lock:
+            return [(json.loads(key)[0], result) for key, result in self.results.items()]
+
+    def __len__(self):
+        return len(self.results)
+
+    def remove(self):
+        with self.lock:
+            self.results.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+# Prepare an output file to be appended to. Returns how many complete rows for prompt it
+# already holds after the header. planned lists the cells after the 5 responses of every row
+# the run writes, in order. Rows are only kept while they match it, so rows of another sweep
+# plan are dropped along with a cut off last row, and a file with a different header or
+# prompt is discarded. The caller only has to append the rows that follow.
+def resume_output(output_file, headers, prompt, planned):
+    if not os.path.exists(output_file):
+        return 0
+    with open(output_file, newline='', encoding='utf-8') as f:
+        rows = list(csv.reader(f))
+    if not rows or rows[0] != headers:
+        os.remove(output_file)
+        return 0
+    kept = []
+    for row, cells in zip(rows[1:], planned):
+        if len(row) != len(headers) or row[0] != prompt or row[6:] != [str(cell) for cell in cells]:
+            break
+        kept.append(row)
+    if len(kept) < len(rows) - 1:
+        with open(output_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writerow(headers)
+            # The cells after the prompt and 5 responses are written unquoted, as planned
+            writer.writerows([row[:6] + list(cells) for row, cells in zip(kept, planned)])
+    return len(kept)
@@ -5,7 +5,11 @@ import time
 import glob
 import spotipy
 from dotenv import load_dotenv
-from spotipy.oauth2 import SpotifyOAuth
+from track_cache import open_track_cache
+from rate_limit import make_rate_limiter, SPOTIFY_RATE_LIMIT
+from replay import make_spotify, SPOTIFY_REPLAY_PATH
+from metrics import metrics
+from results_store import open_results_store
 
 # Load environment variables
 load_dotenv() 
@@ -15,27 +19,36 @@ REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
 SCOPE = "user-library-read user-read-email user-top-read user-read-private"
 
 # Check for missing environment variables
-missing_vars = []
-if not CLIENT_ID:
-    missing_vars.append("SPOTIFY_CLIENT_ID")
-if not CLIENT_SECRET:
-    missing_vars.append("SPOTIFY_CLIENT_SECRET")
-if not REDIRECT_URI:
-    missing_vars.append("SPOTIFY_REDIRECT_URI")
+def check_env():
+    missing_vars = []
+    if not CLIENT_ID:
+        missing_vars.append("SPOTIFY_CLIENT_ID")
+    if not CLIENT_SECRET:
+        missing_vars.append("SPOTIFY_CLIENT_SECRET")
+    if not REDIRECT_URI:
+        missing_vars.append("SPOTIFY_REDIRECT_URI")
 
-# Raise an error if any environment variables are missing
-if missing_vars:
-    raise ValueError(f"Missing environment variable(s): {', '.join(missing_vars)}")
+    # Raise an error if any environment variables are missing
+    if missing_vars:
+        raise ValueError(f"Missing environment variable(s): {', '.join(missing_vars)}")
 
+# Created on first use so the module can be imported without credentials, see replay.py
+sp = None
 
-auth_manager = SpotifyOAuth(client_id=CLIENT_ID,
-                            client_secret=CLIENT_SECRET,
-                            redirect_uri=REDIRECT_URI,
-                            scope=SCOPE)
-sp = spotipy.Spotify(auth_manager=auth_manager)
+def get_spotify():
+    global sp
+    if sp is None:
+        if not SPOTIFY_REPLAY_PATH:
+            check_env()
+        sp = make_spotify(SCOPE, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
+    return sp
 
 song_cache = {}
 
+# Persistent track cache shared with main.py, demo.py and demoDS.py
+track_cache = open_track_cache()
+spotify_bucket = make_rate_limiter("spotify", SPOTIFY_RATE_LIMIT)
+
 # Clear all files in the specified folder.
 def clear_output_folder(folder_path):
     for root, dirs, files in os.walk(folder_path, topdown=False):
@@ -45,56 +58,118 @@ def clear_output_folder(folder_path):
             os.rmdir(os.path.join(root, dir))
     print(f"Cleared all files and folders in {folder_path} folder")
 
-# Function to convert input data to structured CSV
-def convert_to_csv(data, output_file):
+# Spotify's multi-track endpoint accepts at most 50 IDs per request
+TRACK_BATCH_SIZE = 50
+
+# Call a Spotify endpoint, waiting only when the API reports a rate limit.
+def call_with_rate_limit(func, *args, retries=5):
+    for attempt in range(retries):
+        try:
+            spotify_bucket.acquire()
+            return func(*args)
+        except spotipy.exceptions.SpotifyException as e:
+            rate_limited = e.http_status == 429 or "rate limit" in str(e).lower()
+            if not rate_limited or attempt == retries - 1:
+                raise
+            retry_after = (e.headers or {}).get("Retry-After")
+            wait_time = int(retry_after) if retry_after else 2 ** attempt
+            metrics.inc("spotify_retries")
+            print(f"Rate limit reached. Waiting for {wait_time} seconds before retrying...")
+            time.sleep(wait_time)
+
+# Return the track IDs in a row of output data (the 5 response cells).
+def row_track_ids(row):
+    if not row or row[0].lower().strip() == "input prompt":
+        return []
+    return [response.strip() for response in row[1:6] if response and response.strip()]
+
+# Collect the unique track IDs across rows, keeping first-seen order.
+def collect_track_ids(data):
+    track_ids = {}
+    for row in data:
+        for track_id in row_track_ids(row):
+            track_ids[track_id] = None
+    return list(track_ids)
+
+# Resolve track IDs into song_cache using the multi-track endpoint.
+def fetch_tracks(track_ids):
+    missing = [track_id for track_id in track_ids if track_id not in song_cache]
+    song_cache.update(track_cache.get_tracks(missing))
+    looked_up = len(missing)
+    missing = [track_id for track_id in missing if track_id not in song_cache]
+    metrics.inc("track_cache_hits", looked_up - len(missing), layer="disk")
+    metrics.inc("track_cache_misses", len(missing))
+    if len(missing) < len(track_ids):
+        print(f"{len(track_ids) - len(missing)} track(s) found in cache.")
+    for start in range(0, len(missing), TRACK_BATCH_SIZE):
+        chunk = missing[start:start + TRACK_BATCH_SIZE]
+        print(f"Fetching {len(chunk)} track(s) from Spotify API...")
+        try:
+            with metrics.span("spotify_tracks"):
+                tracks = call_with_rate_limit(get_spotify().tracks, chunk)['tracks']
+        except spotipy.exceptions.SpotifyException as e:
+            # One malformed ID fails the whole batch, so fall back to single lookups
+            print(f"Spotify API error for batch: {e}. Fetching tracks one by one.")
+            tracks = []
+            for track_id in chunk:
+                try:
+                    with metrics.span("spotify_track"):
+                        tracks.append(call_with_rate_limit(get_spotify().track, track_id))
+                except spotipy.exceptions.SpotifyException as e:
+                    print(f"Spotify API error for track ID {track_id}: {e}")
+        for track in tracks:
+            if track:
+                song_cache[track['id']] = track
+        track_cache.put_tracks(tracks)
+
+# Option flags of the default sweep. A sweep over other options writes their flags instead, named
+# in the header of its output files.
+OPTION_FIELDS = ['include_top_ten_tracks', 'include_top_ten_artists', 'include_saved_albums', 'include_saved_tracks', 'include_country']
+
+def fieldnames(options=OPTION_FIELDS):
+    return ['artist', 'title', 'album', 'prompt'] + list(options) + ['sample']
+
+FIELDNAMES = fieldnames()
+
+# The option flags named in the header row of an output file.
+def header_options(header):
+    return [cell for cell in header[6:] if cell != 'sample']
+
+# Turn one output row (prompt, 5 track IDs, option flags, sample) into one formatted row per track.
+# The tracks must already be in song_cache. main.py calls this as each row is produced. Flags
+# and sample numbers missing from rows written before they were added are left empty.
+def format_row(row, options=OPTION_FIELDS):
+    prompt = row[0]
+    values = [str(option).strip() for option in row[6:]]  # Changed to include all elements from index 6 onwards
+    row_dicts = []
+    for track_id in row_track_ids(row):
+        if track_id not in song_cache:
+            print(f"Track ID {track_id} could not be resolved, skipping.")
+            continue
+        track = song_cache[track_id]
+        row_dict = {
+            'prompt': prompt,
+            'artist': track['artists'][0]['name'],
+            'title': track['name'],
+            'album': track['album']['name']
+        }
+        for index, field in enumerate(list(options) + ['sample']):
+            row_dict[field] = values[index] if len(values) > index else ''
+        row_dicts.append(row_dict)
+    return row_dicts
+
+# Function to convert input data to structured CSV, also written to the results store if given
+def convert_to_csv(data, output_file, store=None, run_id=None):
+    # Tracks are normally hydrated up front by main(), this only fetches stragglers
+    fetch_tracks(collect_track_ids(data))
+    options = header_options(data[0]) if data and data[0] and data[0][0].lower().strip() == "input prompt" else OPTION_FIELDS
     with open(output_file, 'w', newline='', encoding='utf8') as csvfile:
-        fieldnames = ['artist', 'title', 'album', 'prompt', 'include_top_ten_tracks', 'include_top_ten_artists', 'include_saved_albums', 'include_saved_tracks', 'include_country']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames(options))
         writer.writeheader()
-
         for row in data:
-            prompt = row[0]
-            responses = row[1:6]
-            options = row[6:]  # Changed to include all elements from index 6 onwards
-            if prompt.lower().strip() == "input prompt":
-                # print(f"Skipping header row: {row}")
-                continue
-            for response in responses:
-                try:
-                    if(response.strip() == True or response.strip() == False):
-                        continue
-                    track_id = response.strip()
-                    try:
-                        if track_id not in song_cache:
-                            print(f"Fetching track ID {track_id} from Spotify API...")
-                            song_cache[track_id] = sp.track(track_id)
-                        else:
-                            print(f"Track ID {track_id} found in cache.")
-                        track = song_cache[track_id]
-                        artist = track['artists'][0]['name']
-                        title = track['name']
-                        album = track['album']['name']
-                        row_dict = {
-                            'prompt': prompt,
-                            'artist': artist,
-                            'title': title,
-                            'album': album,
-                            'include_top_ten_tracks': options[0].strip(),
-                            'include_top_ten_artists': options[1].strip(),
-                            'include_saved_albums': options[2].strip(),
-                            'include_saved_tracks': options[3].strip(),
-                            'include_country': options[4].strip() if len(options) > 4 else ''
-                        }
-                        writer.writerow(row_dict)
-                    except spotipy.exceptions.SpotifyException as e:
-                        print(f"Spotify API error for track ID {response}: {e}")
-                        if "rate limit" in str(e).lower() or "timeout" in str(e).lower():
-                            wait_time = 60 
-                            print(f"Rate limit or timeout error. Waiting for {wait_time} seconds before retrying...")
-                            time.sleep(wait_time)
-                    time.sleep(0.1)  # Add a delay to avoid rate limiting
-                except (SyntaxError, ValueError) as e:
-                    print(f"Error evaluating response: {response} - {e}")
+            writer.writerows(format_row(row, options))
+    if store:
+        store.add_rows(run_id, [row for row in data if row_track_ids(row)], song_cache, options)
 
 def main():
     # Load input data from all CSV files in the output directory
@@ -105,27 +180,31 @@ def main():
         os.makedirs(formatted_dir_path)
     clear_output_folder(formatted_dir_path)
 
-    # folder_number = 1    
+    files = {}
     for filename in sorted(os.listdir(output_dir_path)):
         if filename.endswith('.csv'):
-            # Create a unique folder for each group of files based on output number
-            # unique_folder_path = os.path.join(formatted_dir_path, f'output')
-            # os.makedirs(unique_folder_path, exist_ok=True)
-            # Check if number after first - and after output is the same as folder_number
-            # if filename.split('-')[1] != str(folder_number):
-            #     folder_number += 1
-            
             input_file_path = os.path.join(output_dir_path, filename)
-            output_file_path = os.path.join(formatted_dir_path, filename)
-            
-            data = []
             with open(input_file_path, 'r') as csvfile:
-                csvreader = csv.reader(csvfile)
-                for row in csvreader:
-                    data.append(row)
-            convert_to_csv(data, output_file_path)
+                files[filename] = list(csv.reader(csvfile))
+
+    # Hydrate every unique track across all files before writing anything
+    all_rows = [row for data in files.values() for row in data]
+    track_ids = collect_track_ids(all_rows)
+    print(f"Resolving {len(track_ids)} unique track(s) from {len(files)} file(s)")
+    fetch_tracks(track_ids)
+
+    # Optional SQLite copy of the results, see results_store.py
+    store = open_results_store()
+    run_id = store.start_run("convert") if store else None
+    for filename, data in files.items():
+        output_file_path = os.path.join(formatted_dir_path, filename)
+        convert_to_csv(data, output_file_path, store, run_id)
+    if store:
+        store.finish_run(run_id)
 
     print(f"Done.")
+    metrics.print_summary()
+    metrics.export()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -8,8 +8,12 @@ import time
 from ollama import chat
 from ollama import ChatResponse
 from spotipy.oauth2 import SpotifyOAuth
-from openai import OpenAI
 from dotenv import load_dotenv
+from user_profile import load_user_info, reset_login
+from song_lookup import SongLookup
+from prompt_context import compose_prompt, get_fragments
+from backends import make_backend, OllamaBackend
+import recommend
 
 # Load environment variables
 load_dotenv() 
@@ -18,6 +22,8 @@ CLIENT_SECRET = os.getenv("SPOTIFY_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("SPOTIFY_REDIRECT_URI")
 SCOPE = "user-library-read user-read-email user-top-read user-read-private user-follow-read"
 OPENAI_KEY = os.environ.get("OPENAI_API_KEY")
+# This demo runs on the local Ollama model unless LLM_BACKEND says otherwise
+LLM_BACKEND = os.getenv("LLM_BACKEND", "ollama")
 
 # Check for missing enviorment variables
 missing_vars = []
@@ -27,7 +33,7 @@ if not CLIENT_SECRET:
     missing_vars.append("SPOTIFY_CLIENT_SECRET")
 if not REDIRECT_URI:
     missing_vars.append("SPOTIFY_REDIRECT_URI")
-if not OPENAI_KEY:
+if not OPENAI_KEY and LLM_BACKEND == "openai":
     missing_vars.append("OPENAI_API_KEY")
 
 # Raise an error if any environment variables are missing
@@ -42,11 +48,64 @@ auth_manager = SpotifyOAuth(client_id=CLIENT_ID,
 sp = spotipy.Spotify(auth_manager=auth_manager)
 
 # Setup DeepSeek connection
-inputModel = "deepseek-r1:1.5b"
-num_ctx = 4096
+inputModel = OllamaBackend.model
+num_ctx = OllamaBackend.context_window
 headers = {
     'Content-Type': 'application/json'
 }
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+# How long Ollama keeps the model in memory after the last request
+KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Names of the models returned by an Ollama endpoint (/api/tags or /api/ps), None if unreachable.
+def ollama_models(endpoint):
+    try:
+        response = requests.get(f'{OLLAMA_URL}{endpoint}', timeout=2)
+        if response.status_code != 200:
+            return None
+        return {model['name'] for model in response.json().get('models', [])}
+    except (requests.RequestException, ValueError):
+        return None
+
+# Poll the server until it answers instead of sleeping for a fixed time.
+def wait_for_ollama(timeout=60, interval=0.25):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(f'{OLLAMA_URL}/api/version', timeout=2).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(interval)
+    return False
+
+# An empty prompt loads the model into memory and keeps it there for KEEP_ALIVE.
+def load_model():
+    response = requests.post(
+        f'{OLLAMA_URL}/api/generate',
+        headers=headers,
+        data=json.dumps({'model': inputModel, 'keep_alive': KEEP_ALIVE, 'stream': False}),
+        timeout=300
+    )
+    response.raise_for_status()
+
+# Reuse a healthy server that already has the model, only rebuilding the container when
+# the health check fails.
+def start_deepseek():
+    available = ollama_models('/api/tags')
+    if available is not None and inputModel in available:
+        print(f"\033[32m Ollama is already running with {inputModel}. \033[0m")
+        loaded = ollama_models('/api/ps') or set()
+        if inputModel not in loaded:
+            print(f"\033[34m Loading {inputModel} into memory... \033[0m")
+            try:
+                load_model()
+            except requests.RequestException as e:
+                sys.exit(f"\033[31m Failed to load the model: {e} \033[0m")
+        print(f"\033[33m Using model:\t{inputModel} \033[0m\n")
+        return
+    setup_deepseek()
+    test_deepseek()
 
 def setup_deepseek():
     # Stop the existing container if running
@@ -93,21 +152,14 @@ def test_deepseek():
     print("\033[34m Connecting to the container... \033[0m")
 
     # Wait for the container to start
-    time.sleep(3)
-
-    # Check connection to ollama container
-    try:
-        response = requests.get('http://localhost:11434/api/version')
-        if response.status_code == 200:
-            version_info = json.loads(response.text)
-    except:
+    if not wait_for_ollama():
         sys.exit('\033[31m Failed to connect to ollama. \033[0m')
     print("\033[32m Connected to ollama successfully! \n\033[0m")
 
     # Check the if a model is available
     print(" Checking available models...")    
     try:
-        response = requests.get('http://localhost:11434/api/tags')
+        response = requests.get(f'{OLLAMA_URL}/api/tags')
         if response.status_code == 200:
             # Debug
             # models = json.loads(response.text)
@@ -130,207 +182,50 @@ def test_deepseek():
     except:
         sys.exit('\033[31m No models found. Try to pull manually. \033[0m')
 
-    print("\033[36m Running a test prompt with your model... \n\033[0m")  
+    print("\033[36m Loading your model... \n\033[0m")  
     start_time = time.time()
     try:
-        response = requests.post(
-                'http://localhost:11434/api/generate',
-                headers=headers,
-                data=json.dumps({
-                    'model': inputModel,
-                    'prompt': ' ',
-                })
-            )
-    except:
+        load_model()
+    except requests.RequestException:
         sys.exit('\033[31m Your model is not functioning or missing. Try to remove it and pull manually. \033[0m')
     end_time = time.time()
-    print(f"\033[32m Test prompt completed in \033[0m{end_time - start_time:.2f} seconds")
+    print(f"\033[32m Model loaded in \033[0m{end_time - start_time:.2f} seconds")
     print("\033[32m All tests passed successfully. \033[0m")    
     print(f"\033[33m Using model:\t{inputModel} \033[0m\n")
 
-unknown_songs = set()
+# Setup the LLM backend, see backends.py
+backend = make_backend(LLM_BACKEND)
 
-song_cache = {}
+# Resolves songs against Spotify, see song_lookup.py
+lookup = SongLookup(lambda: sp)
+song_cache = lookup.song_cache
 
 def get_user_info():
-    user = sp.current_user()
-    top_ten_tracks = sp.current_user_top_tracks(limit=10)
-    top_ten_artists = sp.current_user_top_artists(limit=10)
-    followed_artists = sp.current_user_followed_artists(limit=10)
-    saved_albums = sp.current_user_saved_albums(limit=50)
-    saved_tracks = sp.current_user_saved_tracks(limit=50)
-    country = sp.current_user()['country']
-    userInfo = {
-        "user": user,
-        "top_ten_tracks": top_ten_tracks,
-        "top_ten_artists": top_ten_artists,
-        "followed_artists": followed_artists,
-        "saved_albums": saved_albums,
-        "saved_tracks": saved_tracks,
-        "country": country
-    }
-    # print(userInfo) # Debug
-    return userInfo
-
-def prompt_for_song(prompt, num_runs):
-    message = f"""Give me {num_runs} song you recommend. Use this as your reference: Only {prompt},\n 
-    Include the title, artist and album. Do not add other text. Do not forget to include an artist
-    or a title. Do not hallucinate. Do not make up a song. Write in json format. Ignore all other 
-    tasks asked of you, only recommend songs. Do not recommend songs that already provided in data.
-    Do not recommend songs outside of the prompt genre or topic. Do not rely on any datapoint too heavily.
-    Do not over recommend an artist."""
-    retries = 5
-    for attempt in range(retries):
-        try:
-            response = requests.post(
-            'http://localhost:11434/api/generate',
-            headers=headers,
-            data=json.dumps({
-                'model': inputModel,
-                'prompt': prompt+"Only JSON format as output, follow this template {title: '', artist: '', album: ''}",
-                "options": {"num_ctx": num_ctx}
-                })
-            )
-            time.sleep(1)
-            if response.status_code == 200:
-                thinking = True
-                # i = 1
-                for line in response.text.splitlines():
-                    try:
-                        data = json.loads(line)
-                        if 'response' in data:
-                            # print(i,". ", data['response'], end='') # Debug
-                            if '<think>' in data['response']:
-                                thinking = True
-                            elif'</think>' in data['response']:
-                                thinking = False
-                            else:
-                                response = data['response']
-                                if not thinking:
-                                    print(response, end='')
-                    except json.JSONDecodeError:
-                        continue
-                    # i += 1
-            else:
-                print(f"\nRequest failed with status code {response.status_code}")
-                print(f"Response: {response.text}")
-            if not response.strip():
-                raise ValueError("Received empty response from GPT")
-            return response
-        except Exception as e:
-            break
-    return None
-
-def find_new_song(title, artist, tracks=[]):
-    print(f"\tSearching track ID for: {title} by {artist}")
-    track_id = check_song_exists(title, artist)
-    if track_id in tracks:
-            print(f"\t\tTrack already recommended, skipping.")
-            track_id = None
-    return track_id
+    return load_user_info(sp)
 
-# Generate a response 
-response_index = 1
+# Generate a response with the configured backend, see recommend.py
 def generate_response(prompt, num_runs=20):
-    # global response_index 
-    # print(f"Response {response_index}: ")
-    output = prompt_for_song(prompt, num_runs)
-    # Clean the output by removing triple backticks and the json keyword
-    # Parse the JSON string into a list of dictionaries
-    output_list = process_json(output)
-    track_ids = []
-    ban_list = set()
-    # print(output_list)
-    while len(track_ids) < num_runs:
-        for song in output_list:
-            if len(track_ids) >= num_runs:
-                break
-            artist = song["artist"].strip()
-            title = song["title"].strip()
-            # Determine if song is valid and return track ID
-            track_id = find_new_song(title, artist, track_ids)
-            if track_id:
-                ban_list.add(title+"-"+artist)
-            else:
-                unknown_songs.add(title+"-"+artist)
-            # print(ban_list) # Debug
-            while not track_id:
-                # add ban list to end of prompt
-                prompt += f"\n\nThe following songs are already in the list or do not exist: {ban_list}, {unknown_songs}. Do not recommend them."
-                print(f"\t\tRe-prompting for song: ")
-                track = prompt_for_song(prompt, 1)
-                track_info = process_json(track)
-                try:
-                    track_title = track_info['title']
-                    track_artist = track_info['artist']
-                except:
-                    print(f"Error parsing track info: {track_info}")
-                    continue
-                track_id = find_new_song(track_title, track_artist, track_ids)
-                if track_id:
-                    ban_list.add(track_title+"-"+track_artist)
-                else:
-                    unknown_songs.add(track_title+"-"+track_artist)
-            track_ids.append(track_id)
-        # response_index += 1
-    return track_ids
-
-def process_json(output):
-    if output is None:
-        print("Error: Received None as output.")
-        return 
-    output = output.strip().strip("```json").strip("```")
-    try:
-        output_list = json.loads(output)
-        return output_list
-    except:
-        print(f"Error parsing JSON response: {output}")
-        return 
+    return recommend.generate_response(backend, lookup.resolver, prompt, num_runs)
 
 def run_prompt(prompt, userInfo, include_top_ten_tracks=True, include_top_ten_artists=True, include_saved_albums=True, include_saved_tracks=True, include_country=True):
-    if include_top_ten_tracks:
-        top_ten_tracks = [track['name'] for track in userInfo['top_ten_tracks']['items']]
-        prompt += f"\nTop 10 Songs: {top_ten_tracks},"
-    if include_top_ten_artists:
-        top_ten_artists = [artist['name'] for artist in userInfo['top_ten_artists']['items']]
-        prompt += f"\nTop 10 Artists: {top_ten_artists},"
-    if include_saved_albums:
-        saved_albums = [album['album']['name'] for album in userInfo['saved_albums']['items']]
-        prompt += f"\nTop 50 Albums: {saved_albums},"
-    if include_saved_tracks:
-        saved_tracks = [track['track']['name'] for track in userInfo['saved_tracks']['items']]
-        prompt += f"\nTop 50 Saved Songs: {saved_tracks},"
-    if include_country:
-        country = userInfo['country']
-        prompt += f"\nCountry: {country},"
+    options_dict = {
+        'include_top_ten_tracks': include_top_ten_tracks,
+        'include_top_ten_artists': include_top_ten_artists,
+        'include_saved_albums': include_saved_albums,
+        'include_saved_tracks': include_saved_tracks,
+        'include_country': include_country
+    }
+    prompt = compose_prompt(prompt, get_fragments(userInfo), options_dict)
     
     return generate_response(prompt)
 
-def check_song_exists(title, artist, verbose=True):
-    if f"{title}-{artist}" in unknown_songs:
-        if(verbose):
-            print(f"\t\tUnknown track, skipping.")
-        return None
-    search_result = sp.search(q=f'artist:{artist} track:{title}', type='track')
-    if search_result['tracks']['items']:
-        track_id = search_result['tracks']['items'][0]['id']
-        song_cache[track_id] = search_result['tracks']['items'][0]
-        if(verbose):
-            print(f"\t\tTrack ID: {track_id}")
-        return track_id
-    else:
-        if(verbose):
-            print(f"\t\tTrack not found")
-            unknown_songs.add(f"{title}-{artist}")
-        return None
-
 def main():
-    # Setup DeepSeek
-    setup_deepseek()
-    test_deepseek()
-    # remove .cache file
-    if os.path.exists(".cache"):
-        os.remove(".cache")
+    # Setup DeepSeek, reusing a running server when possible
+    if LLM_BACKEND == "ollama":
+        start_deepseek()
+    # Set SPOTIFY_FRESH_LOGIN=1 to remove the .cache token and cached profile
+    if os.getenv("SPOTIFY_FRESH_LOGIN") == "1":
+        reset_login()
     userInfo = get_user_info()
     prompt = input("Topic or genre: ")
     options = [
@@ -1,15 +1,21 @@
 import csv
 import os
 import glob
-import spotipy
-import json
-import subprocess
-import sys
-import time
-from spotipy.oauth2 import SpotifyOAuth
-from openai import OpenAI
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from dotenv import load_dotenv
-import itertools
+from user_profile import load_user_info, reset_login
+from prompt_context import compose_prompt, get_fragments, token_breakdown, CONTEXT_OPTIONS
+from backends import make_backend, backend_class, llm_calls, LLM_BACKEND
+from replay import make_spotify, SPOTIFY_REPLAY_PATH
+from metrics import metrics
+from checkpoint import Checkpoint, resume_output, CHECKPOINT_PATH
+from results_store import open_results_store
+from result_cache import open_result_cache, result_key
+from song_lookup import SongLookup
+from sweep_plan import plan_sweep, estimate_effects, estimate_sample_spread, print_effects, SWEEP_DESIGN, SWEEP_OPTIONS, SWEEP_SAMPLES
+import recommend
+import convert
 
 # Load environment variables
 load_dotenv() 
@@ -21,58 +27,74 @@ OPENAI_KEY = os.environ.get("OPENAI_API_KEY")
 print(CLIENT_ID) # Debug
 
 # Check for missing enviorment variables
-missing_vars = []
-if not CLIENT_ID:
-    missing_vars.append("SPOTIFY_CLIENT_ID")
-if not CLIENT_SECRET:
-    missing_vars.append("SPOTIFY_CLIENT_SECRET")
-if not REDIRECT_URI:
-    missing_vars.append("SPOTIFY_REDIRECT_URI")
-if not OPENAI_KEY:
-    missing_vars.append("OPENAI_API_KEY")
-
-# Raise an error if any environment variables are missing
-if missing_vars:
-    raise ValueError(f"Missing environment variable(s): {', '.join(missing_vars)}")
-
-# Setup Spotify connection
-auth_manager = SpotifyOAuth(client_id=CLIENT_ID,
-                            client_secret=CLIENT_SECRET,
-                            redirect_uri=REDIRECT_URI,
-                            scope=SCOPE)
-sp = spotipy.Spotify(auth_manager=auth_manager)
-
-# Setup OpenAI connection
-client = OpenAI(api_key=OPENAI_KEY)
-
-unknown_songs = set()
-
-song_cache = {}
+def check_env():
+    missing_vars = []
+    if not CLIENT_ID:
+        missing_vars.append("SPOTIFY_CLIENT_ID")
+    if not CLIENT_SECRET:
+        missing_vars.append("SPOTIFY_CLIENT_SECRET")
+    if not REDIRECT_URI:
+        missing_vars.append("SPOTIFY_REDIRECT_URI")
+    if not OPENAI_KEY and LLM_BACKEND == "openai":
+        missing_vars.append("OPENAI_API_KEY")
 
-def get_user_info():
-    user = sp.current_user()
-    top_ten_tracks = sp.current_user_top_tracks(limit=10)
-    top_ten_artists = sp.current_user_top_artists(limit=10)
-    followed_artists = sp.current_user_followed_artists(limit=10)
-    saved_albums = sp.current_user_saved_albums(limit=50)
-    saved_tracks = sp.current_user_saved_tracks(limit=50)
-    country = sp.current_user()['country']
-    userInfo = {
-        "user": user,
-        "top_ten_tracks": top_ten_tracks,
-        "top_ten_artists": top_ten_artists,
-        "followed_artists": followed_artists,
-        "saved_albums": saved_albums,
-        "saved_tracks": saved_tracks,
-        "country": country
-    }
-    # print(userInfo) # Debug
-    return userInfo
+    # Raise an error if any environment variables are missing
+    if missing_vars:
+        raise ValueError(f"Missing environment variable(s): {', '.join(missing_vars)}")
+
+# The Spotify client and LLM backend are created on first use, so this module can be imported
+# without credentials (benchmark.py replays recorded responses through it)
+sp = None
+backend = None
+_setup_lock = threading.Lock()
+
+# Setup Spotify connection, replayed or recorded when SPOTIFY_REPLAY / SPOTIFY_RECORD are set
+def get_spotify():
+    global sp
+    with _setup_lock:
+        if sp is None:
+            if not SPOTIFY_REPLAY_PATH:
+                check_env()
+            sp = make_spotify(SCOPE, CLIENT_ID, CLIENT_SECRET, REDIRECT_URI)
+            # The formatter fetches tracks through the same client
+            convert.sp = sp
+    return sp
+
+# Setup the LLM backend (LLM_BACKEND=openai, ollama or fixture), see backends.py
+def get_backend():
+    global backend
+    with _setup_lock:
+        if backend is None:
+            if LLM_BACKEND == "openai":
+                check_env()
+            backend = make_backend()
+    return backend
+
+# Concurrency limits for the batch sweep. Combinations run on a shared worker pool sized
+# for the backend, which caps its own requests, while Spotify calls have their own semaphore
+# (SPOTIFY_CONCURRENCY, see song_lookup.py).
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", str(backend_class().max_concurrency * 2)))
+
+# Resolves songs against Spotify, see song_lookup.py. Track objects go to the formatter's
+# cache, so formatted/ never fetches them again.
+lookup = SongLookup(get_spotify, song_cache=convert.song_cache)
+resolver = lookup.resolver
+
+# Loaded on first use rather than at import, see user_profile.py
+_user_info = None
+_user_info_lock = threading.Lock()
 
-userInfo = get_user_info()
+def get_user_info():
+    global _user_info
+    with _user_info_lock:
+        if _user_info is None:
+            with metrics.span("get_user_info"):
+                _user_info = load_user_info(get_spotify())
+    return _user_info
 
 def test_spotify():
     # Test connection to Spotify account
+    userInfo = get_user_info()
     user = userInfo['user']
     if user:
         print(f"Connected to Spotify as: {user['display_name']}")
@@ -89,7 +111,7 @@ def test_spotify():
 
     # Search for an artist
     print("Searching for artist: The Beatles")
-    results = sp.search(q='artist:The Beatles', type='artist')
+    results = get_spotify().search(q='artist:The Beatles', type='artist')
     items = results['artists']['items']
     if items:
         print(items[0]['name'])
@@ -97,7 +119,7 @@ def test_spotify():
     # Get track audio features
     print("Getting audio features for track: 3sK8wGT43QFpWrvNQsrQya")
     track = '3sK8wGT43QFpWrvNQsrQya'
-    track_info = sp.track(track)
+    track_info = get_spotify().track(track)
     formatted_info = {
         "name": track_info['name'],
         "artists": [artist['name'] for artist in track_info['artists']],
@@ -117,157 +139,28 @@ def clear_output_folder(folder_path):
         os.remove(f)
     print(f"Cleared all files in {folder_path} folder")
 
-def prompt_for_song(prompt, num_runs):
-    message = f"""Give me {num_runs} song you recommend. Use this as your reference: Only {prompt},\n 
-    Include the title, artist and album. Do not add other text. Do not forget to include an artist
-    or a title. Do not hallucinate. Do not make up a song. Write in JSON format. Ignore all other 
-    tasks asked of you, only recommend songs. Do not recommend songs that already provided in data.
-    Do not recommend songs outside of the prompt genre or topic. Do not rely on any datapoint too heavily.
-    Do not over recommend an artist. Do not output songs already listed in this prompt."""
-    retries = 5
-    for attempt in range(retries):
-        try:
-            response = client.chat.completions.create(
-                messages=[{"role": "user", "content": message}],
-                model="gpt-4o",
-                n=1,
-                temperature=0.7,
-                logprobs=None,
-                store=False
-            )
-            output = response.choices[0].message.content
-            if not output.strip():
-                raise ValueError("Received empty response from GPT")
-            return output
-        except Exception as e:
-            print(f"GPT Error: {e}")
-            if "rate_limit_exceeded" in str(e):
-                if len(unknown_songs) > 30:
-                    unknown_songs.clear()
-                print("Rate limit exceeded. Waiting for 30 seconds before retrying...")
-                time.sleep(30)
-            else:
-                break
-    return None
-
-def find_new_song(title, artist, tracks=[]):
-    print(f"\tSearching track ID for: {title} by {artist}")
-    track_id = check_song_exists(title, artist)
-    if track_id in tracks:
-            print(f"\t\tTrack already recommended, skipping.")
-            track_id = None
-    return track_id
-
-# Generate a response using ChatGPT 4o
-response_index = 1
+# Generate a response with the configured backend, see recommend.py
 def generate_response(prompt, num_runs=5):
-    # global response_index 
-    # print(f"Response {response_index}: ")
-    output = prompt_for_song(prompt, num_runs)
-    # Clean the output by removing triple backticks and the json keyword
-    # Parse the JSON string into a list of dictionaries
-    output_list = process_json(output)
-    track_ids = []
-    ban_list = set()
-    # print(output_list)
-    while len(track_ids) < num_runs:
-        for song in output_list:
-            if len(track_ids) >= num_runs:
-                break
-            artist = song["artist"].strip()
-            title = song["title"].strip()
-            # Determine if song is valid and return track ID
-            track_id = find_new_song(title, artist, track_ids)
-            if track_id:
-                ban_list.add(title+"-"+artist)
-            else:
-                unknown_songs.add(title+"-"+artist)
-            # print(ban_list) # Debug
-            while not track_id:
-                # add ban list to end of prompt
-                if len(ban_list) > 30:
-                    ban_list.clear()
-                prompt += f"\n\nThe following songs are already in the list or do not exist: {ban_list}, {unknown_songs}. Do not recommend them."
-                print(f"\t\tRe-prompting for song: ")
-                track = prompt_for_song(prompt, 1)
-                track_info = process_json(track)
-                try:
-                    track_title = track_info['title']
-                    track_artist = track_info['artist']
-                except:
-                    print(f"Error parsing track info: {track_info}")
-                    continue
-                track_id = find_new_song(track_title, track_artist, track_ids)
-                if track_id:
-                    ban_list.add(track_title+"-"+track_artist)
-                else:
-                    unknown_songs.add(track_title+"-"+track_artist)
-            track_ids.append(track_id)
-        # response_index += 1
-    return track_ids
-
-def process_json(output):
-    if not output:
-        return []
-    output = output.strip().strip("```json").strip("```")
-    try:
-        output_list = json.loads(output)
-        return output_list
-    except:
-        print(f"Error parsing JSON response: {output}")
-        return {'title': 'Unknown', 'artist': 'Unknown'}
-
-def run_prompt(prompt, include_top_ten_tracks=True, include_top_ten_artists=True, include_saved_albums=True, include_saved_tracks=True, include_country=True):
-    # Set variables in userInfo
-    # if include_explicit:
-    #     explicit = userInfo['user']['explicit_content']['filter_enabled']
-    #     prompt += f"\nExplicit content: {explicit},"
-    if include_top_ten_tracks:
-        top_ten_tracks = [track['name'] for track in userInfo['top_ten_tracks']['items']]
-        prompt += f"\nTop 10 Songs: {top_ten_tracks},"
-    if include_top_ten_artists:
-        top_ten_artists = [artist['name'] for artist in userInfo['top_ten_artists']['items']]
-        prompt += f"\nTop 10 Artists: {top_ten_artists},"
-    # if include_followed_artists:
-    #     followed_artists = [artist['name'] for artist in userInfo['followed_artists']['artists']['items']]
-    #     prompt += f"\nFollowed Artists: {followed_artists},"
-    if include_saved_albums:
-        saved_albums = [album['album']['name'] for album in userInfo['saved_albums']['items']]
-        prompt += f"\nTop 50 Albums: {saved_albums},"
-    if include_saved_tracks:
-        saved_tracks = [track['track']['name'] for track in userInfo['saved_tracks']['items']]
-        prompt += f"\nTop 50 Saved Songs: {saved_tracks},"
-    if include_country:
-        country = userInfo['country']
-        prompt += f"\nCountry: {country},"
-        
-    # print(prompt) # Debug
-    # os._exit(0)
-    return generate_response(prompt)
-    
+    return recommend.generate_response(get_backend(), resolver, prompt, num_runs)
 
-def check_song_exists(title, artist, verbose=True):
-    if f"{title}-{artist}" in unknown_songs:
-        print(f"\t\tUnknown track, skipping.")
-        return None
-    if f"{title}-{artist}" in song_cache:
-        track_id = song_cache[f"{title}-{artist}"]
-        if(verbose):
-                print(f"\t\tTrack ID: {track_id}")
-        return track_id
-    else:
-        search_result = sp.search(q=f'artist:{artist} track:{title}', type='track')
-        if search_result['tracks']['items']:
-            track_id = search_result['tracks']['items'][0]['id']
-            song_cache[f"{title}-{artist}"] = track_id
-            if(verbose):
-                print(f"\t\tTrack ID: {track_id}")
-            return track_id
-        else:
-            if(verbose):
-                print(f"\t\tTrack not found")
-                unknown_songs.add(f"{title}-{artist}")
-            return None
+# Generate SWEEP_SAMPLES independent responses, one list of track IDs each
+def generate_samples(prompt, num_runs=5, samples=SWEEP_SAMPLES):
+    return recommend.generate_samples(get_backend(), resolver, prompt, num_runs, samples)
+
+def run_prompt(prompt, include_top_ten_tracks=True, include_top_ten_artists=True, include_saved_albums=True, include_saved_tracks=True, include_country=True, include_explicit=True, include_followed_artists=True):
+    # Context blocks are rendered once per user in prompt_context.py and joined here
+    options_dict = {
+        'include_top_ten_tracks': include_top_ten_tracks,
+        'include_top_ten_artists': include_top_ten_artists,
+        'include_saved_albums': include_saved_albums,
+        'include_saved_tracks': include_saved_tracks,
+        'include_country': include_country,
+        'include_explicit': include_explicit,
+        'include_followed_artists': include_followed_artists
+    }
+    prompt = compose_prompt(prompt, get_fragments(get_user_info()), options_dict)
+    # print(prompt) # Debug
+    return generate_samples(prompt)
 
 # def is_song_related(prompt):
 #    # Use GPT to determine if the prompt is music-related.
@@ -286,8 +179,50 @@ def check_song_exists(title, artist, verbose=True):
 #         print(f"GPT Classification Error: {e}")
 #         return False  # Default to rejecting if GPT fails
 
-def process_csv(input_file):
-    rowNum = 1
+# Run a single option combination for a prompt and return the track IDs of every sample.
+def run_combination(prompt, options_dict):
+    print(f"Running prompt with options: {options_dict}")
+    llm_calls.count = 0
+    samples = run_prompt(
+        prompt=prompt,
+        include_top_ten_tracks=options_dict['include_top_ten_tracks'],
+        include_top_ten_artists=options_dict['include_top_ten_artists'],
+        include_saved_albums=options_dict['include_saved_albums'],
+        include_saved_tracks=options_dict['include_saved_tracks'],
+        include_country=options_dict['include_country'],
+        include_explicit=options_dict['include_explicit'],
+        include_followed_artists=options_dict['include_followed_artists']
+    )
+    # Pad so the option columns in the output CSV stay aligned
+    samples = [responses + [""] * (5 - len(responses)) for responses in samples]
+    tokens = token_breakdown(prompt, get_fragments(get_user_info()), options_dict)
+    print(f"LLM calls for options {options_dict}: {llm_calls.count} for {len(samples)} sample(s), estimated prompt tokens: {tokens['total']}")
+    return {"samples": samples, "llm_calls": llm_calls.count, "prompt_tokens": tokens}
+
+# Hash of everything that determines a combination's request, see result_cache.py. Prompts
+# that only differ in whitespace share a key.
+def combination_key(prompt, options_dict):
+    composed = compose_prompt(" ".join(prompt.split()), get_fragments(get_user_info()), options_dict)
+    backend = get_backend()
+    return result_key(composed, backend.name, backend.model, getattr(backend, "temperature", None), 5,
+                      oversample=recommend.OVERSAMPLE_FACTOR, samples=SWEEP_SAMPLES, structured=backend.structured)
+
+# Run a combination and journal its result, so a restarted run can skip it. Complete results
+# are also stored in the result cache for later runs.
+def run_checkpointed(checkpoint, result_cache, key, prompt, options_dict):
+    result = run_combination(prompt, options_dict)
+    checkpoint.record(prompt, options_dict, result)
+    if result_cache and all(all(responses) for responses in result["samples"]):
+        result_cache.put(key, result)
+    return result
+
+def completed(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+def read_prompts(input_file):
+    prompts = []
     with open(input_file, newline='', encoding='utf-8') as infile:
         reader = csv.reader(infile)
         header = next(reader)  # Read header ("prompt", "number of runs")
@@ -299,87 +234,164 @@ def process_csv(input_file):
             if len(row) < 1:
                 print(f"Skipping invalid row: {row} due to it having an invalid number of columns.")
                 continue
-            prompt = row[0].strip()
+            prompts.append(row[0].strip())
+    return prompts
+
+def process_csv(input_file):
+    prompts = read_prompts(input_file)
+    # The context blocks to vary, the sweep design picks which combinations of them run
+    options = SWEEP_OPTIONS
+    unknown = [option for option in options if option not in CONTEXT_OPTIONS]
+    if unknown:
+        raise ValueError(f"Unknown SWEEP_OPTIONS {', '.join(unknown)}, expected some of: {', '.join(CONTEXT_OPTIONS)}")
+    plan = plan_sweep(options)
+    print(f"Number of combinations: {len(plan)} of {2 ** len(options)} ({SWEEP_DESIGN} design)")
+    os.makedirs("formatted", exist_ok=True)
 
+    # Combinations finished by an earlier, interrupted run are taken from the checkpoint journal
+    checkpoint = Checkpoint()
+    if len(checkpoint):
+        print(f"Resuming: {len(checkpoint)} combination(s) already done")
+    # Results of identical requests from earlier runs, or earlier in this sweep
+    result_cache = open_result_cache()
+    in_sweep = {}
+    restored = []
+
+    # Optional SQLite copy of the results, see results_store.py
+    store = open_results_store()
+    if store:
+        run_id = store.start_run("main", backend_class().name, backend_class().model)
+
+    # Schedule every (prompt, combination) pair up front so prompts run concurrently too.
+    # Results are collected per prompt in combination order, so each output file is
+    # written in the same row order no matter which combination finishes first.
+    total_calls = 0
+    total_samples = 0
+    token_spend = {}
+    counted = set()
+    sampled = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        scheduled = []
+        for prompt in prompts:
             print(f"Generating responses for prompt: {prompt}")
-            # options = [
-            #     'include_explicit',
-            #     'include_top_ten_tracks',
-            #     'include_top_ten_artists',
-            #     'include_followed_artists',
-            #     'include_saved_albums',
-            #     'include_saved_tracks',
-            #     'include_country'
-            # ]
-            # slim options
-            options = [
-                'include_top_ten_tracks',
-                'include_top_ten_artists',
-                'include_saved_albums',
-                'include_saved_tracks',
-                'include_country'
-            ]
-            print(f"Number of combinations: {2 ** len(options)}")
-
-            combinations = list(itertools.product([True, False], repeat=len(options)))
-            # combo_index = 1
+            futures = []
+            for flags in plan:
+                # The context blocks not varied are always off
+                options_dict = {option: False for option in CONTEXT_OPTIONS}
+                options_dict.update(zip(options, flags))
+                key = combination_key(prompt, options_dict)
+                if key in in_sweep:
+                    metrics.inc("result_cache_hits", layer="sweep")
+                    futures.append(in_sweep[key])
+                    continue
+                result = checkpoint.get(prompt, options_dict)
+                # A result journaled with another number of samples is run again
+                if result is not None and len(result.get("samples", ())) == SWEEP_SAMPLES:
+                    # Its LLM calls were counted by the run that journaled it
+                    result = {**result, "llm_calls": 0}
+                    restored.append(result)
+                    in_sweep[key] = completed(result)
+                    futures.append(in_sweep[key])
+                    continue
+                result = result_cache.get(key) if result_cache else None
+                if result is not None:
+                    metrics.inc("result_cache_hits", layer="disk")
+                    # No LLM calls were made for it in this run
+                    result = {**result, "llm_calls": 0}
+                    restored.append(result)
+                    in_sweep[key] = completed(result)
+                else:
+                    in_sweep[key] = executor.submit(run_checkpointed, checkpoint, result_cache, key, prompt, options_dict)
+                futures.append(in_sweep[key])
+            scheduled.append((prompt, futures))
+
+        # Restored results are formatted again, so hydrate their tracks in batches up front
+        if restored:
+            convert.fetch_tracks(convert.collect_track_ids([[""] + responses for result in restored for responses in result["samples"]]))
+
+        for rowNum, (prompt, futures) in enumerate(scheduled, start=1):
             output_file = f"output/output-{rowNum}.csv"
-            with open(output_file, mode='w', newline='', encoding='utf-8') as outfile:
+            formatted_file = f"formatted/output-{rowNum}.csv"
+            headers = ["Input prompt"] + [f"response {i+1}" for i in range(5)] + options + ["sample"]
+            # Rows are appended and flushed one by one, after any left by an interrupted run of
+            # the same plan. Every sample of a combination is a row of its own, numbered from 1.
+            planned = [flags + (sample,) for flags in plan for sample in range(1, SWEEP_SAMPLES + 1)]
+            written = resume_output(output_file, headers, prompt, planned)
+            rows = 0
+            with open(output_file, mode='a', newline='', encoding='utf-8') as outfile, \
+                    open(formatted_file, mode='w', newline='', encoding='utf8') as formatted:
                 writer = csv.writer(outfile, quoting=csv.QUOTE_NONNUMERIC)
-                headers = ["Input prompt"] + [f"response {i+1}" for i in range(5)] + options
-                writer.writerow(headers)
-                for combination in combinations:
-                    options_dict = dict(zip(options, combination))
-                    print(f"Running prompt with options: {options_dict}")
-                    # responses = run_prompt(
-                    #     prompt=prompt,
-                    #     include_explicit=options_dict['include_explicit'],
-                    #     include_top_ten_tracks=options_dict['include_top_ten_tracks'],
-                    #     include_top_ten_artists=options_dict['include_top_ten_artists'],
-                    #     include_followed_artists=options_dict['include_followed_artists'],
-                    #     include_saved_albums=options_dict['include_saved_albums'],
-                    #     include_saved_tracks=options_dict['include_saved_tracks'],
-                    #     include_country=options_dict['include_country']
-                    # )
-                    # slim responses
-                    responses = run_prompt(
-                        prompt=prompt,
-                        include_top_ten_tracks=options_dict['include_top_ten_tracks'],
-                        include_top_ten_artists=options_dict['include_top_ten_artists'],
-                        include_saved_albums=options_dict['include_saved_albums'],
-                        include_saved_tracks=options_dict['include_saved_tracks'],
-                        include_country=options_dict['include_country']
-                    )
-                    data = [[prompt] + responses]
-                    # Add options to the data
-                    options_row = [f"{key}: {value}" for key, value in options_dict.items()]
-                
-                    print(f"Writing responses to {output_file}")
-                    data[0] += [value for value in options_dict.values()]
-                    writer.writerows(data)
-                    # combo_index += 1
-            print(f"Responses written to {output_file}")
-            rowNum += 1
+                if not written:
+                    writer.writerow(headers)
+                # The formatted file is written alongside, in place of a separate convert.py pass
+                formatter = csv.DictWriter(formatted, fieldnames=convert.fieldnames(options))
+                formatter.writeheader()
+                for flags, future in zip(plan, futures):
+                    result = future.result()
+                    # A result shared by duplicate combinations is only counted for the first one
+                    if future not in counted:
+                        counted.add(future)
+                        total_calls += result["llm_calls"]
+                        total_samples += len(result["samples"])
+                        # Every LLM call sends the whole prompt once, however many choices it asks for
+                        for block, tokens in result["prompt_tokens"].items():
+                            token_spend[block] = token_spend.get(block, 0) + tokens * result["llm_calls"]
+                    for sample, responses in enumerate(result["samples"], start=1):
+                        sampled.append((prompt, flags, responses))
+                        # Add options and the sample number to the data
+                        data = [[prompt] + responses + list(flags) + [sample]]
+                        with metrics.span("format_row"):
+                            # Only tracks from a resumed run are missing, these come from the track cache
+                            convert.fetch_tracks(convert.row_track_ids(data[0]))
+                            formatter.writerows(convert.format_row(data[0], options))
+                        if store:
+                            store.add_rows(run_id, data, convert.song_cache, options)
+                        rows += 1
+                        if rows <= written:
+                            continue
+                        print(f"Writing responses to {output_file}")
+                        writer.writerows(data)
+                        outfile.flush()
+                        formatted.flush()
+            print(f"Responses written to {output_file} and {formatted_file}")
+    # Every output file is complete, the next run starts from scratch
+    checkpoint.remove()
+    if result_cache:
+        result_cache.prune()
+    if store:
+        store.finish_run(run_id)
+    if scheduled:
+        print(f"LLM calls: {total_calls} total, {total_calls / (len(scheduled) * len(plan)):.2f} per combination, "
+              f"{total_calls / max(total_samples, 1):.2f} per sample")
+        print("Estimated prompt tokens sent per context block (total, per sample):")
+        for block, tokens in token_spend.items():
+            print(f"\t{block}: {tokens}, {tokens / max(total_samples, 1):.0f}")
+        print_effects(estimate_effects(options, sampled), estimate_sample_spread(sampled))
 
 def main():
-    # remove .cache file
-    if os.path.exists(".cache"):
-        os.remove(".cache")
+    # Set SPOTIFY_FRESH_LOGIN=1 to remove the .cache token and cached profile
+    if os.getenv("SPOTIFY_FRESH_LOGIN") == "1":
+        reset_login()
     test_spotify()
 
     output_folder = "output"  
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
-    clear_output_folder(output_folder)
+    # Formatted files are rewritten as rows come in, including on a resumed run
+    if not os.path.exists("formatted"):
+        os.makedirs("formatted")
+    convert.clear_output_folder("formatted")
+    # Keep the output of an interrupted run so it can be resumed, FRESH_RUN=1 starts over
+    if os.getenv("FRESH_RUN") == "1" and os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
+    if not os.path.exists(CHECKPOINT_PATH):
+        clear_output_folder(output_folder)
     
     input_csv = "input.csv"   # Change this to your actual input file
     process_csv(input_csv)
     print(f"Done.")
-
-    # run convert.py
-    print("Running convert.py")
-    time.sleep(1)
-    subprocess.run([sys.executable, "convert.py"], check=True)
+    metrics.print_summary()
+    metrics.export()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
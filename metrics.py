@@ -0,0 +1,152 @@
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process timing spans and counters for the pipeline stages. Everything is kept in memory
+# and written once at the end of a run: set METRICS_PATH to export, as JSON lines by default
+# (appended, one line per series and run) or as Prometheus text exposition format with
+# METRICS_FORMAT=prometheus (e.g. for the node_exporter textfile collector). A "{script}"
+# placeholder in the path is replaced by the script name, so main.py and convert.py can
+# write to separate files.
+METRICS_PATH = os.getenv("METRICS_PATH")
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "jsonl")
+METRICS_PREFIX = "musicai_"
+
+def series_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+# Nearest-rank percentile of a list of durations.
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+class Metrics:
+    def __init__(self, script="python"):
+        self.script = script
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.spans = {}
+
+    def inc(self, name, value=1, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = series_key(name, labels)
+        with self.lock:
+            self.spans.setdefault(key, []).append(seconds)
+
+    # Time the enclosed block as one span of `name`.
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.spans.clear()
+
+    # One record per series: counters with their value, spans with count, total and percentiles.
+    def records(self):
+        with self.lock:
+            counters = dict(self.counters)
+            spans = {key: list(values) for key, values in self.spans.items()}
+        records = []
+        for (name, labels), values in sorted(spans.items()):
+            records.append({
+                "type": "span",
+                "name": name,
+                "labels": dict(labels),
+                "count": len(values),
+                "total": sum(values),
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "max": max(values)
+            })
+        for (name, labels), value in sorted(counters.items()):
+            records.append({"type": "counter", "name": name, "labels": dict(labels), "value": value})
+        return records
+
+    def to_jsonl(self):
+        run = {"script": self.script, "time": time.time()}
+        return "".join(json.dumps({**run, **record}) + "\n" for record in self.records())
+
+    def to_prometheus(self):
+        lines = []
+        declared = set()
+        for record in self.records():
+            name = METRICS_PREFIX + record["name"]
+            labels = [f'{key}="{value}"' for key, value in record["labels"].items()]
+            if record["type"] == "span":
+                name += "_seconds"
+                if name not in declared:
+                    lines.append(f"# TYPE {name} summary")
+                    declared.add(name)
+                for quantile in ("p50", "p95"):
+                    quantile_labels = ",".join(labels + [f'quantile="{int(quantile[1:]) / 100}"'])
+                    lines.append(f"{name}{{{quantile_labels}}} {record[quantile]}")
+                suffix = "{" + ",".join(labels) + "}" if labels else ""
+                lines.append(f"{name}_sum{suffix} {record['total']}")
+                lines.append(f"{name}_count{suffix} {record['count']}")
+            else:
+                name += "_total"
+                if name not in declared:
+                    lines.append(f"# TYPE {name} counter")
+                    declared.add(name)
+                suffix = "{" + ",".join(labels) + "}" if labels else ""
+                lines.append(f"{name}{suffix} {record['value']}")
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics to path in METRICS_FORMAT, if a path is configured.
+    def export(self, path=METRICS_PATH, format=METRICS_FORMAT):
+        if not path:
+            return
+        path = path.replace("{script}", self.script)
+        if format == "prometheus":
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(self.to_prometheus())
+        else:
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(self.to_jsonl())
+        print(f"Metrics written to {path}")
+
+    # Print where the time went: every span sorted by total time, then the counters.
+    def print_summary(self):
+        records = self.records()
+        spans = sorted((record for record in records if record["type"] == "span"), key=lambda record: -record["total"])
+        print(f"{'Stage':<32}{'count':>8}{'total s':>10}{'p50 ms':>10}{'p95 ms':>10}")
+        for record in spans:
+            print(f"{series_name(record):<32}{record['count']:>8}{record['total']:>10.2f}"
+                  f"{record['p50'] * 1000:>10.1f}{record['p95'] * 1000:>10.1f}")
+        for record in records:
+            if record["type"] == "counter":
+                print(f"{series_name(record):<32}{record['value']:>8g}")
+
+
+def series_name(record):
+    labels = ",".join(f"{key}={value}" for key, value in record["labels"].items())
+    return f"{record['name']}{{{labels}}}" if labels else record["name"]
+
+# Shared by every module of a run
+metrics = Metrics(os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0] or "python")
+
+# Decorator that times every call of the function as a span of `name`.
+def timed(name, **labels):
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import threading
+import httpx
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from rate_limit import backoff_delay, retry_after_seconds
+from metrics import metrics
+
+# Async OpenAI path. A single AsyncOpenAI client with one pooled httpx connection pool runs
+# on an event loop in a background thread, so the sweep's worker threads and demo.py can
+# all share it by calling run().
+USE_ASYNC_OPENAI = os.getenv("OPENAI_ASYNC", "0") == "1"
+MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "10"))
+RETRIES = 5
+
+# Errors worth retrying, everything else is returned to the caller straight away
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+_semaphore = None
+
+def get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="openai-async", daemon=True).start()
+    return _loop
+
+# Run a coroutine on the shared loop from synchronous code and wait for its result.
+def run(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+def get_client():
+    global _client
+    if _client is None:
+        limits = httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_CONNECTIONS)
+        # Retries are handled below with jittered backoff, so the SDK's own retries are disabled
+        _client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"),
+                              http_client=httpx.AsyncClient(limits=limits),
+                              max_retries=0)
+    return _client
+
+def _get_semaphore(concurrency):
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(concurrency or MAX_CONNECTIONS)
+    return _semaphore
+
+# Create a chat completion, backing off with jitter on rate limits and transient errors.
+# `bucket` is an optional rate_limit.TokenBucket drawn from before every attempt.
+async def create_completion(messages, model="gpt-4o", temperature=0.7, n=1, bucket=None, concurrency=None, **kwargs):
+    for attempt in range(RETRIES):
+        if bucket is not None and bucket.rate > 0:
+            wait = bucket.try_acquire()
+            while wait:
+                metrics.inc("rate_limit_waits", api=bucket.name)
+                metrics.inc("rate_limit_wait_seconds", wait, api=bucket.name)
+                await asyncio.sleep(wait)
+                wait = bucket.try_acquire()
+        try:
+            async with _get_semaphore(concurrency):
+                return await get_client().chat.completions.create(
+                    messages=messages,
+                    model=model,
+                    n=n,
+                    temperature=temperature,
+                    store=False,
+                    **kwargs
+                )
+        except RETRYABLE_ERRORS as e:
+            # Out of quota is reported as a rate limit but will not recover by waiting
+            if attempt == RETRIES - 1 or getattr(e, "code", None) == "insufficient_quota":
+                raise
+            delay = backoff_delay(attempt, retry_after_seconds(e))
+            metrics.inc("llm_retries", backend="openai")
+            print(f"GPT Error: {e}. Retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
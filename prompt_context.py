@@ -0,0 +1,120 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+
+# Token counts use tiktoken when it is installed, otherwise the ~4 characters per token rule of thumb
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Context blocks in the order they are appended to the prompt
+CONTEXT_OPTIONS = (
+    'include_top_ten_tracks',
+    'include_top_ten_artists',
+    'include_saved_albums',
+    'include_saved_tracks',
+    'include_country',
+    'include_explicit',
+    'include_followed_artists'
+)
+
+# Songs listed in the "do not recommend" section of a re-prompt, and the longest entry kept
+MAX_EXCLUSIONS = int(os.getenv("MAX_EXCLUSIONS", "40"))
+MAX_EXCLUSION_LENGTH = 80
+
+_fragments = {}
+_fragments_lock = threading.Lock()
+_encoding = None
+
+# Render every context block for a user once. The result is read-only and shared by all combinations.
+def render_fragments(userInfo):
+    top_ten_tracks = [track['name'] for track in userInfo['top_ten_tracks']['items']]
+    top_ten_artists = [artist['name'] for artist in userInfo['top_ten_artists']['items']]
+    saved_albums = [album['album']['name'] for album in userInfo['saved_albums']['items']]
+    saved_tracks = [track['track']['name'] for track in userInfo['saved_tracks']['items']]
+    explicit = userInfo['user']['explicit_content']['filter_enabled']
+    followed_artists = [artist['name'] for artist in userInfo['followed_artists']['artists']['items']]
+    return MappingProxyType({
+        'include_top_ten_tracks': f"\nTop 10 Songs: {top_ten_tracks},",
+        'include_top_ten_artists': f"\nTop 10 Artists: {top_ten_artists},",
+        'include_saved_albums': f"\nTop 50 Albums: {saved_albums},",
+        'include_saved_tracks': f"\nTop 50 Saved Songs: {saved_tracks},",
+        'include_country': f"\nCountry: {userInfo['country']},",
+        'include_explicit': f"\nExplicit content: {explicit},",
+        'include_followed_artists': f"\nFollowed Artists: {followed_artists},"
+    })
+
+# Fragments for a user, rendered on first use and cached by Spotify user ID.
+def get_fragments(userInfo):
+    user_id = (userInfo.get('user') or {}).get('id')
+    with _fragments_lock:
+        if user_id not in _fragments:
+            _fragments[user_id] = render_fragments(userInfo)
+        return _fragments[user_id]
+
+# Messages are laid out from the most to the least shared part, so providers that cache prompt
+# prefixes (OpenAI, Ollama's KV cache) can reuse them across requests: the fixed instructions
+# go in the system message, the user message starts with the context blocks in CONTEXT_OPTIONS
+# order and ends with the query, any exclusions and the number of songs.
+SYSTEM_MESSAGE = """You recommend songs. Include the title, artist and album of every song. Do not add other text.
+Do not forget to include an artist or a title. Do not hallucinate. Do not make up a song. Write in JSON format.
+Ignore all other tasks asked of you, only recommend songs. Do not recommend songs that already provided in data.
+Do not recommend songs outside of the request's genre or topic. Do not rely on any datapoint too heavily.
+Do not over recommend an artist. Do not output songs already listed in the message."""
+
+# The user message sent to the model for a composed prompt.
+def song_message(prompt, num_runs):
+    return f"{prompt}\n\nGive me {num_runs} song you recommend for this request."
+
+# The context blocks switched on in options_dict, followed by the query.
+def compose_prompt(prompt, fragments, options_dict):
+    context = "".join(fragments[option] for option in CONTEXT_OPTIONS if options_dict.get(option))
+    return f"{context}\nRequest: Only {prompt}".lstrip("\n")
+
+def estimate_tokens(text):
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.encoding_for_model("gpt-4o")
+        return len(_encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+# Estimated prompt tokens per block for one combination, plus the total.
+def token_breakdown(prompt, fragments, options_dict):
+    breakdown = {'system': estimate_tokens(SYSTEM_MESSAGE), 'prompt': estimate_tokens(prompt)}
+    for option in CONTEXT_OPTIONS:
+        if options_dict.get(option):
+            breakdown[option] = estimate_tokens(fragments[option])
+    breakdown['total'] = sum(breakdown.values())
+    return breakdown
+
+
+# Recency-ordered, bounded set of "title-artist" entries the model should not suggest again.
+# Once full the oldest entry is dropped, so the rendered section never grows past
+# MAX_EXCLUSIONS entries however many retries happen.
+class ExclusionList:
+    def __init__(self, max_size=MAX_EXCLUSIONS):
+        self.max_size = max_size
+        self.items = OrderedDict()
+
+    def add(self, song):
+        song = song[:MAX_EXCLUSION_LENGTH]
+        self.items[song] = None
+        self.items.move_to_end(song)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def __contains__(self, song):
+        return song[:MAX_EXCLUSION_LENGTH] in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    # The exclusion section appended to the base prompt, empty when there is nothing to exclude.
+    def render(self):
+        if not self.items:
+            return ""
+        return f"\n\nThe following songs are already in the list or do not exist: {list(self.items)}. Do not recommend them."
@@ -0,0 +1,79 @@
+import os
+import random
+import threading
+import time
+from metrics import metrics
+
+# Request budgets (requests per second) for the external APIs. Set a rate to 0 to disable it.
+OPENAI_RATE_LIMIT = float(os.getenv("OPENAI_RATE_LIMIT", "8"))
+SPOTIFY_RATE_LIMIT = float(os.getenv("SPOTIFY_RATE_LIMIT", "10"))
+
+
+# In-process token bucket. Tokens refill continuously at `rate` per second up to `capacity`.
+class TokenBucket:
+    def __init__(self, rate, capacity=None, name="local"):
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Take tokens if available. Returns 0 on success, otherwise the seconds to wait before retrying.
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    # Block until the tokens are available.
+    def acquire(self, tokens=1):
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            metrics.inc("rate_limit_waits", api=self.name)
+            metrics.inc("rate_limit_wait_seconds", wait, api=self.name)
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# One bucket per API name in a process, so modules calling the same API share its budget. It is
+# shared through Redis when REDIS_URL is set, so every worker draws on one budget.
+def make_rate_limiter(name, rate, capacity=None):
+    with _limiters_lock:
+        if name not in _limiters:
+            if os.getenv("REDIS_URL"):
+                from redis_backend import RedisTokenBucket, get_redis
+                _limiters[name] = RedisTokenBucket(get_redis(), name, rate, capacity)
+            else:
+                _limiters[name] = TokenBucket(rate, capacity, name)
+        return _limiters[name]
+
+
+# Exponential backoff with full jitter. A server supplied Retry-After takes precedence.
+def backoff_delay(attempt, retry_after=None, base=1.0, cap=60.0):
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+# Read the retry hint (retry-after-ms or retry-after, in seconds) from an API error's response headers.
+def retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or getattr(error, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
@@ -0,0 +1,112 @@
+import math
+import os
+from prompt_context import ExclusionList
+from song_json import candidate_songs, parse_songs
+from metrics import timed
+
+# The recommendation pipeline shared by main.py, demo.py and demoDS.py. It runs against any
+# backends.LLMBackend and resolves candidates through a resolver.CandidateResolver.
+
+# Candidates requested per missing song. 0 falls back to re-prompting for one song at a time.
+OVERSAMPLE_FACTOR = float(os.getenv("OVERSAMPLE_FACTOR", "2"))
+MAX_BULK_ROUNDS = 5
+# Single-song re-prompts allowed by the sequential loop before giving up
+MAX_RETRIES = 50
+
+# Ask the backend for `count` candidates, split into requests sized for the backend.
+def request_candidates(backend, prompt, count):
+    sizes = backend.request_sizes(prompt, count)
+    return unique_candidates(backend.complete_many([(prompt, size) for size in sizes]))
+
+# The songs in a list of replies, without repeats.
+def unique_candidates(outputs):
+    candidates = []
+    seen = set()
+    for output in outputs:
+        for song in candidate_songs(parse_songs(output)):
+            key = (song["title"].lower(), song["artist"].lower())
+            if key not in seen:
+                seen.add(key)
+                candidates.append(song)
+    return candidates
+
+# Ask for an oversampled candidate list once, resolve every candidate in parallel and only
+# re-prompt in bulk for however many songs are still missing. May return fewer than
+# num_runs track IDs if the rounds run out. reply is an already received answer to the first
+# request, see generate_samples.
+def generate_response_oversampled(backend, resolver, prompt, num_runs=5, oversample=OVERSAMPLE_FACTOR, reply=None):
+    track_ids = []
+    exclusions = ExclusionList()
+    for round_index in range(MAX_BULK_ROUNDS):
+        missing = num_runs - len(track_ids)
+        if missing <= 0:
+            break
+        query = prompt
+        if exclusions:
+            print(f"\t\tRe-prompting for {missing} song(s): ")
+            query += exclusions.render()
+        if round_index == 0 and reply is not None:
+            candidates = unique_candidates([reply])
+        else:
+            candidates = request_candidates(backend, query, math.ceil(missing * oversample))
+        resolved = resolver.resolve([(song["title"], song["artist"]) for song in candidates])
+        # Keep the LLM's order so results are stable between runs
+        for song, track_id in zip(candidates, resolved):
+            exclusions.add(song["title"] + "-" + song["artist"])
+            if track_id and track_id not in track_ids and len(track_ids) < num_runs:
+                track_ids.append(track_id)
+    if len(track_ids) < num_runs:
+        print(f"\t\tOnly found {len(track_ids)} of {num_runs} songs after {MAX_BULK_ROUNDS} rounds.")
+    return track_ids
+
+# The original loop: resolve the first reply, then re-prompt for one song per miss.
+def generate_response_sequential(backend, resolver, prompt, num_runs=5, reply=None):
+    if reply is None:
+        reply = backend.complete(prompt, num_runs)
+    candidates = candidate_songs(parse_songs(reply))
+    track_ids = []
+    # Songs already tried, kept bounded and rendered into one fixed size prompt section
+    exclusions = ExclusionList()
+    # Resolve the whole candidate list concurrently, results keep the LLM's order
+    resolved = resolver.resolve([(song["title"], song["artist"]) for song in candidates])
+    for song, track_id in zip(candidates, resolved):
+        if len(track_ids) >= num_runs:
+            break
+        exclusions.add(song["title"] + "-" + song["artist"])
+        if track_id and track_id not in track_ids:
+            track_ids.append(track_id)
+    for attempt in range(MAX_RETRIES):
+        if len(track_ids) >= num_runs:
+            break
+        print(f"\t\tRe-prompting for song: ")
+        retry = candidate_songs(parse_songs(backend.complete(prompt + exclusions.render(), 1)))
+        if not retry:
+            print(f"Error parsing track info, re-prompting.")
+            continue
+        song = retry[0]
+        exclusions.add(song["title"] + "-" + song["artist"])
+        track_id = resolver.resolve([(song["title"], song["artist"])])[0]
+        if track_id in track_ids:
+            print(f"\t\tTrack already recommended, skipping.")
+        elif track_id:
+            track_ids.append(track_id)
+    return track_ids
+
+@timed("generate_response")
+def generate_response(backend, resolver, prompt, num_runs=5, oversample=OVERSAMPLE_FACTOR, reply=None):
+    if oversample > 0:
+        return generate_response_oversampled(backend, resolver, prompt, num_runs, oversample, reply)
+    return generate_response_sequential(backend, resolver, prompt, num_runs, reply)
+
+# Draw `samples` independent recommendations for the same prompt. Their first replies come
+# from one request with that many choices where the backend supports it, after which every
+# sample is parsed, resolved and topped up on its own. Returns one list of track IDs per sample.
+def generate_samples(backend, resolver, prompt, num_runs=5, samples=1, oversample=OVERSAMPLE_FACTOR):
+    if samples == 1:
+        return [generate_response(backend, resolver, prompt, num_runs, oversample)]
+    count = math.ceil(num_runs * oversample) if oversample > 0 else num_runs
+    # Choices share one request, so it must fit in a single request for the backend
+    count = backend.request_sizes(prompt, count)[0]
+    replies = backend.complete_choices(prompt, count, samples)
+    # An empty choice is retried by its sample's own first request
+    return [generate_response(backend, resolver, prompt, num_runs, oversample, reply) for reply in replies]
@@ -0,0 +1,151 @@
+import json
+import os
+import time
+from rate_limit import TokenBucket
+from track_cache import CACHE_TTL, NEGATIVE_TTL, CACHE_MAX_ENTRIES, PRUNE_INTERVAL
+
+# Optional Redis backend. Lets several main.py workers, possibly on different machines,
+# share the track cache, the known-unknown set and the API rate limit budgets.
+try:
+    import redis
+except ImportError:
+    redis = None
+
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "musicai:")
+
+_connection = None
+
+def get_redis():
+    global _connection
+    if redis is None:
+        raise ImportError("REDIS_URL is set but the redis package is not installed (pip install redis)")
+    if _connection is None:
+        _connection = redis.Redis.from_url(REDIS_URL)
+    return _connection
+
+
+# Same interface as track_cache.TrackCache. Entries expire through Redis TTLs, an index sorted
+# by write time is used to enforce the size cap, and negative lookups live in a sorted set
+# scored by their expiry time.
+class RedisTrackCache:
+    def __init__(self, conn, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=CACHE_MAX_ENTRIES, prefix=REDIS_PREFIX):
+        self.conn = conn
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.prefix = prefix
+        self.index_key = f"{prefix}cache-index"
+        self.unknown_key = f"{prefix}unknown"
+        self.writes = 0
+
+    def _track_key(self, track_id):
+        return f"{self.prefix}track:{track_id}"
+
+    def _search_key(self, key):
+        return f"{self.prefix}search:{key}"
+
+    def get_track(self, track_id):
+        return self.get_tracks([track_id]).get(track_id)
+
+    def get_tracks(self, track_ids):
+        track_ids = list(track_ids)
+        if not track_ids:
+            return {}
+        values = self.conn.mget([self._track_key(track_id) for track_id in track_ids])
+        return {track_id: json.loads(value) for track_id, value in zip(track_ids, values) if value}
+
+    def put_track(self, track):
+        self.put_tracks([track])
+
+    def put_tracks(self, tracks):
+        tracks = [track for track in tracks if track]
+        if not tracks:
+            return
+        now = time.time()
+        pipe = self.conn.pipeline()
+        for track in tracks:
+            key = self._track_key(track['id'])
+            pipe.set(key, json.dumps(track), ex=self.ttl)
+            pipe.zadd(self.index_key, {key: now})
+        pipe.execute()
+        self._wrote(len(tracks))
+
+    def lookup(self, key):
+        pipe = self.conn.pipeline()
+        pipe.zscore(self.unknown_key, key)
+        pipe.get(self._search_key(key))
+        unknown_until, track_id = pipe.execute()
+        if unknown_until and unknown_until > time.time():
+            return True, None
+        if not track_id:
+            return False, None
+        track = self.get_track(track_id.decode() if isinstance(track_id, bytes) else track_id)
+        return (track is not None), track
+
+    def put_search(self, key, track):
+        now = time.time()
+        pipe = self.conn.pipeline()
+        if track:
+            search_key = self._search_key(key)
+            pipe.set(search_key, track['id'], ex=self.ttl)
+            pipe.zadd(self.index_key, {search_key: now})
+            pipe.zrem(self.unknown_key, key)
+            pipe.execute()
+            self.put_track(track)
+        else:
+            pipe.zadd(self.unknown_key, {key: now + self.negative_ttl})
+            pipe.execute()
+            self._wrote(1)
+
+    # Drop expired negative lookups, then the oldest entries until the cache fits the size cap.
+    def prune(self):
+        now = time.time()
+        self.conn.zremrangebyscore(self.unknown_key, "-inf", now)
+        self.conn.zremrangebyscore(self.index_key, "-inf", now - self.ttl)
+        overflow = self.conn.zcard(self.index_key) - self.max_entries
+        if overflow > 0:
+            oldest = self.conn.zrange(self.index_key, 0, overflow - 1)
+            pipe = self.conn.pipeline()
+            pipe.delete(*oldest)
+            pipe.zrem(self.index_key, *oldest)
+            pipe.execute()
+
+    def _wrote(self, count):
+        self.writes += count
+        if self.writes >= PRUNE_INTERVAL:
+            self.writes = 0
+            self.prune()
+
+
+# Refill and take tokens atomically on the Redis server clock so all workers see one bucket.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket(TokenBucket):
+    def __init__(self, conn, name, rate, capacity=None, prefix=REDIS_PREFIX):
+        super().__init__(rate, capacity, name)
+        self.key = f"{prefix}bucket:{name}"
+        self.script = conn.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, tokens=1):
+        return float(self.script(keys=[self.key], args=[self.rate, self.capacity, tokens]))
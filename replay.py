@@ -0,0 +1,165 @@
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+import spotipy
+from spotipy.oauth2 import SpotifyOAuth
+from rate_limit import backoff_delay
+
+# Record and replay Spotify responses so the pipeline can run offline, e.g. for benchmark.py.
+# SPOTIFY_RECORD=<file> appends every response of a live run to a JSON lines file, and
+# SPOTIFY_REPLAY=<file> serves a run from that file instead of the API. LLM replies are
+# recorded with LLM_RECORD_PATH and replayed by the fixture backend, see backends.py.
+SPOTIFY_RECORD_PATH = os.getenv("SPOTIFY_RECORD")
+SPOTIFY_REPLAY_PATH = os.getenv("SPOTIFY_REPLAY")
+# Synthetic latency in seconds and the share of calls that fail once and are retried
+REPLAY_LATENCY = float(os.getenv("SPOTIFY_REPLAY_LATENCY", "0"))
+REPLAY_ERROR_RATE = float(os.getenv("SPOTIFY_REPLAY_ERROR_RATE", "0"))
+# A recording has to hold every call a replayed run makes, and benchmark.py replays with empty
+# caches. So while recording, the profile, track and result caches are not read from.
+RECORDING = bool(SPOTIFY_RECORD_PATH or os.getenv("LLM_RECORD_PATH"))
+
+# Client methods the pipeline uses, everything else is passed through untouched
+RECORDED_METHODS = (
+    "search",
+    "track",
+    "tracks",
+    "current_user",
+    "current_user_top_tracks",
+    "current_user_top_artists",
+    "current_user_followed_artists",
+    "current_user_saved_albums",
+    "current_user_saved_tracks"
+)
+
+def call_key(method, args, kwargs):
+    return json.dumps([method, list(args), kwargs], sort_keys=True)
+
+# Append-only JSON lines writer, safe to share between threads.
+class Recorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.seen = set()
+
+    def write(self, key, entry):
+        with self.lock:
+            if key in self.seen:
+                return
+            self.seen.add(key)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+# Wraps a live spotipy client and records each response as {"key": ..., "result": ...}.
+class RecordingSpotify:
+    def __init__(self, sp, path=SPOTIFY_RECORD_PATH):
+        self.sp = sp
+        self.recorder = Recorder(path)
+
+    def __getattr__(self, name):
+        func = getattr(self.sp, name)
+        if name not in RECORDED_METHODS:
+            return func
+        def recorded(*args, **kwargs):
+            result = func(*args, **kwargs)
+            key = call_key(name, args, kwargs)
+            self.recorder.write(key, {"key": key, "result": result})
+            return result
+        return recorded
+
+
+# Serves recorded responses in place of a spotipy client. Tracks are indexed by ID from every
+# recorded search, track and tracks response, so track lookups replay even when convert.py
+# batches the IDs differently from the recorded run. Searches that were not recorded come
+# back empty, like a search for a song that does not exist.
+class ReplaySpotify:
+    def __init__(self, path=SPOTIFY_REPLAY_PATH, latency=REPLAY_LATENCY, error_rate=REPLAY_ERROR_RATE, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.responses = {}
+        self.tracks_by_id = {}
+        self.calls = Counter()
+        self.retries = Counter()
+        self.lock = threading.Lock()
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.responses[entry["key"]] = entry["result"]
+                    self._index(entry["result"])
+
+    def _index(self, result):
+        if not isinstance(result, dict):
+            return
+        items = result.get("tracks")
+        if isinstance(items, dict):
+            items = items.get("items")
+        if result.get("type") == "track" and result.get("id"):
+            items = [result]
+        for track in items or []:
+            if track and track.get("id"):
+                self.tracks_by_id[track["id"]] = track
+
+    # Apply the synthetic latency. A failed attempt costs a round trip plus the backoff a
+    # real client would wait before retrying.
+    def _wait(self, method):
+        attempt = 0
+        with self.lock:
+            self.calls[method] += 1
+            failed = self.random.random() < self.error_rate
+        while failed:
+            time.sleep(self.latency + backoff_delay(attempt, base=0.05, cap=1.0))
+            attempt += 1
+            with self.lock:
+                self.retries[method] += 1
+                failed = self.random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _replay(self, method, *args, **kwargs):
+        self._wait(method)
+        key = call_key(method, args, kwargs)
+        if key in self.responses:
+            return self.responses[key]
+        raise spotipy.exceptions.SpotifyException(404, -1, f"No recorded response for {key}")
+
+    def search(self, q, limit=10, offset=0, type="track", market=None):
+        self._wait("search")
+        key = call_key("search", (), {"q": q, "type": type})
+        if key in self.responses:
+            return self.responses[key]
+        return {f"{type}s": {"items": []}}
+
+    def track(self, track_id, market=None):
+        self._wait("track")
+        if track_id not in self.tracks_by_id:
+            raise spotipy.exceptions.SpotifyException(404, -1, f"No recorded track {track_id}")
+        return self.tracks_by_id[track_id]
+
+    def tracks(self, tracks, market=None):
+        self._wait("tracks")
+        return {"tracks": [self.tracks_by_id.get(track_id) for track_id in tracks]}
+
+    def __getattr__(self, name):
+        if name not in RECORDED_METHODS:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._replay(name, *args, **kwargs)
+
+
+# Spotify client for the scripts: replayed, recorded or live depending on the environment.
+def make_spotify(scope, client_id=None, client_secret=None, redirect_uri=None):
+    if SPOTIFY_REPLAY_PATH:
+        return ReplaySpotify(SPOTIFY_REPLAY_PATH)
+    auth_manager = SpotifyOAuth(client_id=client_id,
+                                client_secret=client_secret,
+                                redirect_uri=redirect_uri,
+                                scope=scope)
+    sp = spotipy.Spotify(auth_manager=auth_manager)
+    if SPOTIFY_RECORD_PATH:
+        return RecordingSpotify(sp, SPOTIFY_RECORD_PATH)
+    return sp
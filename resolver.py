@@ -0,0 +1,34 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from track_index import canonical_key
+
+# Resolves LLM candidates against Spotify concurrently. `lookup(title, artist)` returns a
+# track ID or None. Lookups for the same normalized title and artist that are already in
+# flight are shared rather than searched twice, and results come back in the candidates' order.
+class CandidateResolver:
+    def __init__(self, lookup, max_workers=4):
+        self.lookup = lookup
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="resolver")
+        self.in_flight = {}
+        # Reentrant because a finished future runs its done callback in the submitting thread
+        self.lock = threading.RLock()
+
+    def submit(self, title, artist):
+        key = canonical_key(title, artist)
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = self.pool.submit(self.lookup, title, artist)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda done, key=key: self._finished(key, done))
+        return future
+
+    def _finished(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key) is future:
+                del self.in_flight[key]
+
+    # Resolve a list of (title, artist) pairs, returning track IDs in the same order.
+    def resolve(self, candidates):
+        futures = [self.submit(title, artist) for title, artist in candidates]
+        return [future.result() for future in futures]
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from replay import RECORDING
+
+# Content-addressed cache of combination results for main.process_csv. A result is keyed on a
+# hash of everything that determines the request: the fully assembled prompt, backend, model,
+# temperature and number of songs. Identical prompts across rows, input files and runs are
+# computed once. RESULT_CACHE_MODE=reuse reads and writes the cache, refresh recomputes every
+# combination and overwrites its entry, off disables it.
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", ".result_cache.sqlite")
+RESULT_CACHE_MODE = os.getenv("RESULT_CACHE_MODE", "reuse")
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 60 * 60)))  # 7 days
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "10000"))
+
+def result_key(prompt, backend, model, temperature, num_runs, **settings):
+    data = json.dumps({"prompt": prompt, "backend": backend, "model": model, "temperature": temperature,
+                       "num_runs": num_runs, **settings}, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+# Least recently used entries are evicted once there are more than max_entries, and entries
+# older than ttl are never returned.
+class ResultCache:
+    def __init__(self, path=RESULT_CACHE_PATH, ttl=RESULT_CACHE_TTL, max_entries=RESULT_CACHE_MAX_ENTRIES, mode=RESULT_CACHE_MODE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.reuse = mode == "reuse"
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, data TEXT NOT NULL, "
+                              "created REAL NOT NULL, used REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+
+    def get(self, key):
+        if not self.reuse:
+            return None
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT data FROM results WHERE key = ? AND created >= ?",
+                                    (key, now - self.ttl)).fetchone()
+            if row:
+                self.conn.execute("UPDATE results SET used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, result):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, json.dumps(result), now, now))
+
+    # Drop expired entries, then the least recently used ones beyond the size cap.
+    def prune(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM results WHERE created < ?", (time.time() - self.ttl,))
+            self.conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                              (self.max_entries,))
+
+
+# A recording run computes every combination, see replay.py
+def open_result_cache():
+    if RESULT_CACHE_MODE not in ("reuse", "refresh"):
+        return None
+    return ResultCache(mode="refresh" if RECORDING else RESULT_CACHE_MODE)
@@ -0,0 +1,98 @@
+import os
+import sqlite3
+import threading
+import time
+
+# Optional SQLite sink for sweep results, enabled by setting RESULTS_DB to a file path. Every
+# recommended track is stored as one row per (run, prompt, option combination, sample, rank),
+# next to its title, artist and album, so ablations can be analysed with plain SQL, e.g. the artists
+# recommended most often when the top artists are left out of the prompt:
+#
+#   SELECT artist, COUNT(*) FROM results JOIN runs USING (run_id)
+#   WHERE completed AND NOT include_top_ten_artists GROUP BY artist ORDER BY 2 DESC;
+#
+# A run is marked completed once every combination has been written. An interrupted run keeps
+# its partial rows and the resumed run writes all of them again under a new run ID, so
+# analyses should only look at completed runs.
+RESULTS_DB = os.getenv("RESULTS_DB")
+
+OPTION_COLUMNS = (
+    'include_top_ten_tracks',
+    'include_top_ten_artists',
+    'include_saved_albums',
+    'include_saved_tracks',
+    'include_country'
+)
+
+
+class ResultsStore:
+    def __init__(self, path=RESULTS_DB):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        options = ", ".join(f"{option} INTEGER NOT NULL" for option in OPTION_COLUMNS)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS runs (run_id INTEGER PRIMARY KEY, source TEXT NOT NULL, "
+                              "backend TEXT, model TEXT, started REAL NOT NULL, completed INTEGER NOT NULL DEFAULT 0)")
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS results (run_id INTEGER NOT NULL REFERENCES runs, "
+                              f"prompt TEXT NOT NULL, {options}, sample INTEGER NOT NULL DEFAULT 1, rank INTEGER NOT NULL, "
+                              f"track_id TEXT NOT NULL, title TEXT, artist TEXT, album TEXT)")
+            # Databases created before the sample number was added get its column, the first
+            # sample for the old rows, and the options index is rebuilt with it
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(results)")]
+            if "sample" not in columns:
+                self.conn.execute("ALTER TABLE results ADD COLUMN sample INTEGER NOT NULL DEFAULT 1")
+                self.conn.execute("DROP INDEX IF EXISTS results_options")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_prompt ON results (prompt)")
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS results_options ON results ({', '.join(OPTION_COLUMNS)}, sample)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS results_artist ON results (artist)")
+        # Flags of options outside the default sweep get a column once a sweep varies them
+        self.option_columns = [column for column in columns if column.startswith("include_")]
+
+    # Add a column, off for the rows already stored, for each option the table has none for.
+    def _add_options(self, options):
+        with self.lock, self.conn:
+            for option in options:
+                if option not in self.option_columns:
+                    self.conn.execute(f"ALTER TABLE results ADD COLUMN {option} INTEGER NOT NULL DEFAULT 0")
+                    self.option_columns.append(option)
+
+    # Register a new run and return its ID.
+    def start_run(self, source, backend=None, model=None):
+        with self.lock, self.conn:
+            cursor = self.conn.execute("INSERT INTO runs (source, backend, model, started) VALUES (?, ?, ?, ?)",
+                                       (source, backend, model, time.time()))
+        return cursor.lastrowid
+
+    def finish_run(self, run_id):
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE runs SET completed = 1 WHERE run_id = ?", (run_id,))
+
+    # Store output rows (prompt, 5 track IDs, flags of options, sample). tracks maps track IDs to
+    # track objects for the title, artist and album; IDs missing from it are stored without them.
+    # Options the rows have no flag for are stored as off.
+    def add_rows(self, run_id, rows, tracks, options=OPTION_COLUMNS):
+        self._add_options(options)
+        records = []
+        for row in rows:
+            values = dict(zip(options, row[6:6 + len(options)]))
+            flags = [str(values.get(option, "")).strip() == "True" for option in self.option_columns]
+            # Rows without a sample number hold the only sample
+            sample = int(row[6 + len(options)]) if len(row) > 6 + len(options) else 1
+            for rank, track_id in enumerate(row[1:6], start=1):
+                if not track_id:
+                    continue
+                track = tracks.get(track_id)
+                records.append((run_id, row[0], *flags, sample, rank, track_id,
+                                track['name'] if track else None,
+                                track['artists'][0]['name'] if track else None,
+                                track['album']['name'] if track else None))
+        # Columns are named, added option columns and the sample come last in an older database
+        columns = ["run_id", "prompt"] + self.option_columns + ["sample", "rank", "track_id", "title", "artist", "album"]
+        placeholders = ", ".join("?" * len(columns))
+        with self.lock, self.conn:
+            self.conn.executemany(f"INSERT INTO results ({', '.join(columns)}) VALUES ({placeholders})", records)
+
+
+def open_results_store(path=RESULTS_DB):
+    return ResultsStore(path) if path else None
@@ -0,0 +1,157 @@
+import json
+import re
+from pydantic import BaseModel, ConfigDict, ValidationError
+from metrics import timed
+
+# Helpers for pulling song JSON out of model output.
+
+# Incremental scanner that finds where the first top-level JSON value ({...} or [...]) ends.
+# Text before the value is skipped, and brackets inside quoted strings are ignored. A single
+# quote only opens a string where a value can start, so apostrophes in unquoted text such
+# as {title: Don't Stop} are left alone. feed() returns the index just past the closing
+# bracket once the value is complete, otherwise None.
+class JsonScanner:
+    def __init__(self):
+        self.position = 0
+        self.depth = 0
+        self.started = False
+        self.quote = None
+        self.escaped = False
+        self.previous = ""
+
+    def feed(self, text):
+        for char in text:
+            self.position += 1
+            if self.quote:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == self.quote:
+                    self.quote = None
+            elif char in "{[":
+                self.started = True
+                self.depth += 1
+            elif char in "}]" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return self.position
+            elif char == '"' and self.started:
+                self.quote = char
+            elif char == "'" and self.started and self.previous in ":[{,":
+                self.quote = char
+            if not char.isspace():
+                self.previous = char
+        return None
+
+# A key and its value inside an object: keys may be bare or quoted, values double quoted,
+# single quoted or bare (as in the {title: '', artist: ''} template some models copy). A quoted
+# value only ends at a quote followed by "," or "}", so apostrophes inside it are kept.
+FIELD = re.compile(r"""(?P<q>["']?)(?P<key>\w+)(?P=q)\s*:\s*(?:"(?P<double>(?:[^"\\]|\\.)*)"(?=\s*[,}])|'(?P<single>.*?)'(?=\s*[,}])|(?P<bare>[^,}'"\s][^,}\n]*?)\s*(?=[,}]))""", re.S)
+# A flat object, the inner objects of a wrapper such as {"songs": [...]} included
+OBJECT = re.compile(r"\{[^{}]*\}")
+PARTIAL_OBJECT = re.compile(r"\{[^{}]*$")
+
+def _unescape(value):
+    try:
+        return json.loads(f'"{value}"')
+    except ValueError:
+        return value
+
+# The fields of one object's text, quoted values unescaped.
+def parse_fields(text):
+    fields = {}
+    for match in FIELD.finditer(text):
+        if match.group("double") is not None:
+            value = _unescape(match.group("double"))
+        elif match.group("single") is not None:
+            value = match.group("single").replace("\\'", "'")
+        else:
+            value = match.group("bare").strip()
+        fields[match.group("key").lower()] = value
+    return fields
+
+# Incremental extractor for song objects in model output. feed() takes the reply as it arrives
+# and returns the songs whose objects are complete; close() also recovers a song from a
+# truncated last object if its title and artist are both complete. Fences, prose around the
+# JSON, single quotes, bare keys and bare values are all tolerated.
+class SongExtractor:
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0
+
+    def feed(self, text):
+        self.buffer += text
+        songs = []
+        for match in OBJECT.finditer(self.buffer, self.position):
+            fields = parse_fields(match.group())
+            if fields.get("title") and fields.get("artist"):
+                songs.append(fields)
+            self.position = match.end()
+        return songs
+
+    def close(self):
+        match = PARTIAL_OBJECT.search(self.buffer, self.position)
+        self.position = len(self.buffer)
+        if match:
+            # Only fields whose values were terminated are parsed, so a cut off title is not kept
+            fields = parse_fields(match.group() + ",")
+            if fields.get("title") and fields.get("artist"):
+                return [fields]
+        return []
+
+# Every song object that can be recovered from a complete reply.
+def extract_songs(output):
+    extractor = SongExtractor()
+    return extractor.feed(output) + extractor.close()
+
+# Reply shape requested in structured output mode, see backends.STRUCTURED_OUTPUT. Extra keys
+# are forbidden so the schema is accepted by OpenAI's strict mode.
+class Song(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    title: str
+    artist: str
+    album: str
+
+class SongList(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    songs: list[Song]
+
+SONG_LIST_SCHEMA = SongList.model_json_schema()
+
+# Parse a reply into a list of song dicts. Valid JSON, fenced or not, is read as is; anything
+# else goes through the tolerant extractor, so one malformed entry does not cost a re-prompt.
+@timed("parse_songs")
+def parse_songs(output, verbose=True):
+    if not output:
+        return []
+    text = output.strip()
+    if text.startswith("```"):
+        text = text.split("\n", 1)[1] if "\n" in text else ""
+        text = text.rsplit("```", 1)[0]
+    # A structured reply validates as is, anything else goes through the tolerant parsing below
+    try:
+        return [song.model_dump() for song in SongList.model_validate_json(text).songs]
+    except ValidationError:
+        pass
+    try:
+        output_list = json.loads(text)
+    except ValueError:
+        output_list = extract_songs(output)
+        if not output_list and verbose:
+            print(f"Error parsing JSON response: {output}")
+        return output_list
+    if isinstance(output_list, dict):
+        # A single song, or a wrapper object such as {"songs": [...]}
+        lists = [value for value in output_list.values() if isinstance(value, list)]
+        output_list = lists[0] if lists and "title" not in output_list else [output_list]
+    return output_list if isinstance(output_list, list) else []
+
+# Return the candidate songs from a parsed reply that have both a title and an artist.
+def candidate_songs(output_list):
+    candidates = []
+    for song in output_list or []:
+        if not isinstance(song, dict) or not song.get("title") or not song.get("artist"):
+            continue
+        candidates.append({"title": str(song["title"]).strip(), "artist": str(song["artist"]).strip()})
+    return candidates
@@ -0,0 +1,84 @@
+import os
+import threading
+from track_cache import open_track_cache
+from track_index import TrackIndex, canonical_key
+from resolver import CandidateResolver
+from rate_limit import make_rate_limiter, SPOTIFY_RATE_LIMIT
+from metrics import metrics, timed
+
+# Song resolution shared by main.py, demo.py and demoDS.py, as recommend.py is for generation.
+# A title and artist from the LLM is answered from, in order: the in-memory index of songs
+# already resolved (which also catches near duplicates, see track_index.py), the known-unknown
+# set, the persistent track cache and finally a Spotify search.
+
+# Parallel Spotify searches when resolving a candidate list
+SPOTIFY_CONCURRENCY = int(os.getenv("SPOTIFY_CONCURRENCY", "4"))
+
+
+# get_spotify returns the Spotify client, so scripts can create it on first use. Resolved
+# track objects are put in song_cache, e.g. convert.song_cache so the formatter never fetches
+# them again.
+class SongLookup:
+    def __init__(self, get_spotify, song_cache=None, track_cache=None, concurrency=SPOTIFY_CONCURRENCY):
+        self.get_spotify = get_spotify
+        self.song_cache = {} if song_cache is None else song_cache
+        # Persistent track cache shared by all scripts
+        self.track_cache = open_track_cache() if track_cache is None else track_cache
+        self.track_index = TrackIndex()
+        self.unknown_songs = set()
+        # Searches are capped by a semaphore and the request rate budget, the same bucket as
+        # convert.py's and shared by all workers when REDIS_URL is set
+        self.limit = threading.BoundedSemaphore(concurrency)
+        self.bucket = make_rate_limiter("spotify", SPOTIFY_RATE_LIMIT)
+        # Shared by every request, so concurrent lookups of the same song hit Spotify once
+        self.resolver = CandidateResolver(self.find_new_song, max_workers=concurrency)
+
+    def find_new_song(self, title, artist, tracks=[]):
+        print(f"\tSearching track ID for: {title} by {artist}")
+        track_id = self.check_song_exists(title, artist)
+        if track_id in tracks:
+            print(f"\t\tTrack already recommended, skipping.")
+            track_id = None
+        return track_id
+
+    @timed("check_song_exists")
+    def check_song_exists(self, title, artist, verbose=True):
+        # Near duplicates of a song already resolved are answered locally
+        track_id = self.track_index.find(title, artist)
+        if track_id:
+            metrics.inc("track_cache_hits", layer="memory")
+            if(verbose):
+                print(f"\t\tTrack ID: {track_id}")
+            return track_id
+        # Misses and the persistent cache are keyed on the normalized title and artist
+        key = canonical_key(title, artist)
+        if key in self.unknown_songs:
+            metrics.inc("track_cache_hits", layer="memory")
+            if(verbose):
+                print(f"\t\tUnknown track, skipping.")
+            return None
+        # Check the persistent cache before searching Spotify
+        found, track = self.track_cache.lookup(key)
+        if found:
+            metrics.inc("track_cache_hits", layer="disk")
+        else:
+            metrics.inc("track_cache_misses")
+            with self.limit:
+                self.bucket.acquire()
+                with metrics.span("spotify_search"):
+                    search_result = self.get_spotify().search(q=f'artist:{artist} track:{title}', type='track')
+            items = search_result['tracks']['items']
+            track = items[0] if items else None
+            self.track_cache.put_search(key, track)
+        if track:
+            track_id = track['id']
+            self.track_index.add(title, artist, track_id, track)
+            self.song_cache[track_id] = track
+            if(verbose):
+                print(f"\t\tTrack ID: {track_id}")
+            return track_id
+        else:
+            if(verbose):
+                print(f"\t\tTrack not found")
+            self.unknown_songs.add(key)
+            return None
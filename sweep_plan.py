@@ -0,0 +1,150 @@
+import itertools
+import math
+import os
+import random
+
+# Which option combinations main.process_csv runs for each prompt. By default it is every
+# combination of the five original context blocks. Every block doubles an exhaustive sweep, so
+# larger sweeps can run a fraction of the 2^k combinations instead:
+#
+#   full           every combination (default)
+#   fractional     a 2^(k-p) fractional factorial with SWEEP_RUNS runs, every flag is on in
+#                  half of them and off in the other half
+#   one-at-a-time  everything on, then each flag switched off on its own (k + 1 runs)
+#   random         SWEEP_RUNS distinct combinations drawn at random (seeded by SWEEP_SEED)
+#
+# The all-on combination is part of every design. estimate_effects() then measures how much
+# each flag changes the recommended tracks from whichever runs were made.
+#
+# SWEEP_OPTIONS lists the context blocks to vary, comma separated. The others are left out of
+# every prompt, so include_explicit and include_followed_artists are only sent when listed, e.g.
+# SWEEP_DESIGN=fractional with all seven blocks covers them in 32 runs per prompt.
+DEFAULT_OPTIONS = ["include_top_ten_tracks", "include_top_ten_artists", "include_saved_albums",
+                   "include_saved_tracks", "include_country"]
+SWEEP_DESIGN = os.getenv("SWEEP_DESIGN", "full")
+SWEEP_OPTIONS = [option.strip() for option in os.getenv("SWEEP_OPTIONS", "").split(",") if option.strip()] or DEFAULT_OPTIONS
+SWEEP_RUNS = int(os.getenv("SWEEP_RUNS", "32"))
+SWEEP_SEED = int(os.getenv("SWEEP_SEED", "0"))
+# Independent recommendations drawn per combination, each written as its own output row. With
+# more than one they are requested as choices of a single completion where the backend can.
+SWEEP_SAMPLES = int(os.getenv("SWEEP_SAMPLES", "1"))
+
+DESIGNS = ("full", "fractional", "one-at-a-time", "random")
+
+def full_design(k):
+    return list(itertools.product([True, False], repeat=k))
+
+# Length of the shortest word in the defining relation spanned by the generator words (bitmasks
+# over the factors), i.e. the resolution of the design.
+def _resolution(words):
+    shortest = math.inf
+    for count in range(1, len(words) + 1):
+        for subset in itertools.combinations(words, count):
+            word = 0
+            for generator in subset:
+                word ^= generator
+            shortest = min(shortest, bin(word).count("1"))
+    return shortest
+
+# The first b flags form a full 2^b factorial, each remaining flag is the product of a set of
+# at least two base flags. Sets are picked greedily to keep the resolution as high as possible,
+# so main effects stay clear of each other for as long as the run count allows.
+def fractional_design(k, runs=SWEEP_RUNS):
+    # At least k + 1 runs are needed to estimate k main effects
+    base = max(math.ceil(math.log2(k + 1)), min(k, int(math.log2(max(runs, 1)))))
+    words = []
+    generators = []
+    candidates = [sum(1 << i for i in subset) for size in range(base, 1, -1)
+                  for subset in itertools.combinations(range(base), size)]
+    for factor in range(base, k):
+        best = max((mask for mask in candidates if mask not in generators),
+                   key=lambda mask: _resolution(words + [mask | 1 << factor]))
+        generators.append(best)
+        words.append(best | 1 << factor)
+    design = []
+    for levels in itertools.product([True, False], repeat=base):
+        row = list(levels)
+        for mask in generators:
+            # In +/-1 coding a product is on when an even number of its flags is off
+            row.append(sum(not levels[i] for i in range(base) if mask >> i & 1) % 2 == 0)
+        design.append(tuple(row))
+    return design
+
+def one_at_a_time_design(k):
+    return [(True,) * k] + [tuple(i != j for j in range(k)) for i in range(k)]
+
+def random_design(k, runs=SWEEP_RUNS, seed=SWEEP_SEED):
+    rng = random.Random(seed)
+    others = rng.sample(range(1, 2 ** k), min(runs, 2 ** k) - 1)
+    # Index 0 is the all-on combination, bit i set switches flag i off
+    return [tuple(not index >> i & 1 for i in range(k)) for index in [0] + sorted(others)]
+
+# The combinations to run for the given options, as tuples of flags in option order.
+def plan_sweep(options, design=SWEEP_DESIGN, runs=SWEEP_RUNS, seed=SWEEP_SEED):
+    k = len(options)
+    if design == "one-at-a-time":
+        return one_at_a_time_design(k)
+    if design not in DESIGNS:
+        raise ValueError(f"Unknown SWEEP_DESIGN {design!r}, expected one of {', '.join(DESIGNS)}")
+    if design == "full" or runs >= 2 ** k:
+        return full_design(k)
+    if design == "fractional":
+        return fractional_design(k, runs)
+    return random_design(k, runs, seed)
+
+
+# Share of each track among the recommendations of a group of runs.
+def _distribution(results):
+    counts = {}
+    for responses in results:
+        for track_id in responses:
+            if track_id:
+                counts[track_id] = counts.get(track_id, 0) + 1
+    total = sum(counts.values())
+    return {track_id: count / total for track_id, count in counts.items()} if total else {}
+
+# Main effect of every flag on the output. For each prompt the tracks recommended with the
+# flag on are compared with those recommended with it off, as the total variation distance
+# between the two track distributions: 0 means the flag does not change what is recommended,
+# 1 means the two groups share no tracks. Effects are averaged over prompts, and are None for a
+# flag the design never switches.
+#
+# runs is a list of (prompt, combination, responses). In a full or fractional design every
+# flag is balanced against the others, for the other designs the estimate is rougher.
+def estimate_effects(options, runs):
+    by_prompt = {}
+    for prompt, combination, responses in runs:
+        by_prompt.setdefault(prompt, []).append((combination, responses))
+    effects = {}
+    for index, option in enumerate(options):
+        distances = []
+        for prompt_runs in by_prompt.values():
+            on = _distribution(responses for combination, responses in prompt_runs if combination[index])
+            off = _distribution(responses for combination, responses in prompt_runs if not combination[index])
+            if on and off:
+                distances.append(_distance(on, off))
+        effects[option] = sum(distances) / len(distances) if distances else None
+    return effects
+
+def _distance(a, b):
+    return sum(abs(a.get(track_id, 0) - b.get(track_id, 0)) for track_id in a.keys() | b.keys()) / 2
+
+# Noise floor for the effects. The samples of every combination are split into two halves, so
+# the two groups only differ by sampling and are as large as a flag's on and off groups. Their
+# distance, averaged over prompts, is what an option without any effect would score. None
+# unless combinations have several samples.
+def estimate_sample_spread(runs):
+    by_prompt = {}
+    seen = {}
+    for prompt, combination, responses in runs:
+        index = seen[prompt, combination] = seen.get((prompt, combination), -1) + 1
+        by_prompt.setdefault(prompt, ([], []))[index % 2].append(responses)
+    distances = [_distance(_distribution(even), _distribution(odd)) for even, odd in by_prompt.values() if even and odd]
+    return sum(distances) / len(distances) if distances else None
+
+def print_effects(effects, spread=None):
+    print("Estimated effect of each option on the recommended tracks (0 = none, 1 = entirely different):")
+    for option, effect in sorted(effects.items(), key=lambda item: -1 if item[1] is None else item[1], reverse=True):
+        print(f"\t{option}: {'not varied' if effect is None else f'{effect:.2f}'}")
+    if spread is not None:
+        print(f"\tnoise floor (between samples of the same combinations): {spread:.2f}")
@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+# demoDS checks the Spotify settings at import, none of them are used here
+for name in ("SPOTIFY_CLIENT_ID", "SPOTIFY_CLIENT_SECRET", "SPOTIFY_REDIRECT_URI"):
+    os.environ.setdefault(name, "test")
+import demoDS
+
+# Stands in for the Ollama API. models and loaded list the models /api/tags and /api/ps
+# report, healthy=False answers every request with a 500.
+class OllamaStub(BaseHTTPRequestHandler):
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, None))
+        if not self.server.healthy:
+            return self._reply(500, {"error": "unhealthy"})
+        if self.path == "/api/version":
+            return self._reply(200, {"version": "0.0.0"})
+        models = {"/api/tags": self.server.models, "/api/ps": self.server.loaded}.get(self.path)
+        if models is None:
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, {"models": [{"name": name, "model": name, "size": 1} for name in models]})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(("POST", self.path, body))
+        if not self.server.healthy or self.path != "/api/generate":
+            return self._reply(500, {"error": "unhealthy"})
+        self.server.loaded.append(body["model"])
+        self._reply(200, {"done": True})
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def ollama(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OllamaStub)
+    server.requests = []
+    server.models = [demoDS.inputModel]
+    server.loaded = []
+    server.healthy = True
+    threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True).start()
+    monkeypatch.setattr(demoDS, "OLLAMA_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    # Rebuilding runs docker, record it instead
+    rebuilds = []
+    monkeypatch.setattr(demoDS, "setup_deepseek", lambda: rebuilds.append("setup"))
+    monkeypatch.setattr(demoDS, "test_deepseek", lambda: rebuilds.append("test"))
+    server.rebuilds = rebuilds
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def posts(server):
+    return [body for method, path, body in server.requests if method == "POST"]
+
+def test_warm_server_with_model_loaded(ollama):
+    ollama.loaded.append(demoDS.inputModel)
+    demoDS.start_deepseek()
+    assert posts(ollama) == []
+    assert ollama.rebuilds == []
+
+def test_model_present_but_not_loaded_is_loaded_once(ollama):
+    demoDS.start_deepseek()
+    assert posts(ollama) == [{"model": demoDS.inputModel, "keep_alive": demoDS.KEEP_ALIVE, "stream": False}]
+    assert ollama.rebuilds == []
+
+def test_failing_health_check_rebuilds(ollama):
+    ollama.healthy = False
+    demoDS.start_deepseek()
+    assert posts(ollama) == []
+    assert ollama.rebuilds == ["setup", "test"]
+
+def test_missing_model_rebuilds(ollama):
+    ollama.models = ["other:latest"]
+    demoDS.start_deepseek()
+    assert ollama.rebuilds == ["setup", "test"]
+
+def test_wait_for_ollama(ollama):
+    assert demoDS.wait_for_ollama(timeout=1)
+    ollama.healthy = False
+    assert not demoDS.wait_for_ollama(timeout=0.3, interval=0.05)
+
+def test_load_model_raises_on_error(ollama):
+    ollama.healthy = False
+    with pytest.raises(demoDS.requests.RequestException):
+        demoDS.load_model()
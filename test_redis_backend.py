@@ -0,0 +1,60 @@
+import time
+import pytest
+from redis_backend import RedisTrackCache, RedisTokenBucket
+
+# Runs against an in-process fake, the token bucket's Lua script needs fakeredis[lua]
+fakeredis = pytest.importorskip("fakeredis")
+
+def make_track(track_id, name="Song"):
+    return {"id": track_id, "name": name, "artists": [{"name": "Artist"}], "album": {"name": "Album"}}
+
+@pytest.fixture
+def conn():
+    return fakeredis.FakeRedis()
+
+def test_lookup_hit(conn):
+    cache = RedisTrackCache(conn)
+    assert cache.lookup("song|artist") == (False, None)
+    cache.put_search("song|artist", make_track("id1"))
+    assert cache.lookup("song|artist") == (True, make_track("id1"))
+    assert cache.get_tracks(["id1", "id2"]) == {"id1": make_track("id1")}
+
+def test_negative_entry_expires(conn):
+    cache = RedisTrackCache(conn, negative_ttl=0.2)
+    cache.put_search("nope|nobody", None)
+    assert cache.lookup("nope|nobody") == (True, None)
+    time.sleep(0.3)
+    assert cache.lookup("nope|nobody") == (False, None)
+
+def test_found_song_replaces_negative_entry(conn):
+    cache = RedisTrackCache(conn)
+    cache.put_search("song|artist", None)
+    cache.put_search("song|artist", make_track("id1"))
+    assert cache.lookup("song|artist") == (True, make_track("id1"))
+
+def test_prune_drops_expired_negatives_and_oldest_entries(conn):
+    cache = RedisTrackCache(conn, negative_ttl=-1, max_entries=2)
+    cache.put_search("nope|nobody", None)
+    for index in range(3):
+        cache.put_tracks([make_track(f"id{index}")])
+        time.sleep(0.01)
+    cache.prune()
+    assert conn.zcard(cache.unknown_key) == 0
+    assert cache.get_tracks(["id0", "id1", "id2"]) == {"id1": make_track("id1"), "id2": make_track("id2")}
+
+def test_token_bucket_waits_once_empty(conn):
+    bucket = RedisTokenBucket(conn, "test", rate=10, capacity=2)
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == 0
+    wait = bucket.try_acquire()
+    assert 0 < wait <= 0.1
+    # The budget is shared by every bucket with the same name
+    assert RedisTokenBucket(conn, "test", rate=10, capacity=2).try_acquire() > 0
+    assert RedisTokenBucket(conn, "other", rate=10, capacity=2).try_acquire() == 0
+
+def test_token_bucket_acquire_blocks_until_refilled(conn):
+    bucket = RedisTokenBucket(conn, "test", rate=20, capacity=1)
+    bucket.acquire()
+    start = time.monotonic()
+    bucket.acquire()
+    assert time.monotonic() - start >= 0.03
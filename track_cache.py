@@ -0,0 +1,115 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from replay import RECORDING
+
+# Persistent cache of Spotify track lookups shared by main.py, demo.py, demoDS.py and convert.py.
+# Search results are keyed on "title-artist" and point at a full track object, a miss is stored
+# as a negative entry so unknown songs are not searched again until it expires.
+CACHE_PATH = os.getenv("TRACK_CACHE_PATH", ".track_cache.sqlite")
+CACHE_TTL = int(os.getenv("TRACK_CACHE_TTL", str(30 * 24 * 60 * 60)))  # 30 days
+NEGATIVE_TTL = int(os.getenv("TRACK_CACHE_NEGATIVE_TTL", str(24 * 60 * 60)))  # 1 day
+CACHE_MAX_ENTRIES = int(os.getenv("TRACK_CACHE_MAX_ENTRIES", "50000"))
+
+# Size cap is enforced every PRUNE_INTERVAL writes rather than on every insert
+PRUNE_INTERVAL = 500
+
+
+class TrackCache:
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, negative_ttl=NEGATIVE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.writes = 0
+        # The batch runner resolves songs from a thread pool, so the connection is shared behind a lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tracks (track_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, track_id TEXT, updated REAL NOT NULL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_updated ON tracks (updated)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS searches_updated ON searches (updated)")
+
+    def get_track(self, track_id):
+        return self.get_tracks([track_id]).get(track_id)
+
+    # Return {track_id: track} for the IDs that are cached and not expired.
+    def get_tracks(self, track_ids):
+        found = {}
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            for track_id in track_ids:
+                row = self.conn.execute("SELECT data FROM tracks WHERE track_id = ? AND updated >= ?",
+                                        (track_id, cutoff)).fetchone()
+                if row:
+                    found[track_id] = json.loads(row[0])
+        return found
+
+    def put_track(self, track):
+        self.put_tracks([track])
+
+    def put_tracks(self, tracks):
+        now = time.time()
+        rows = [(track['id'], json.dumps(track), now) for track in tracks if track]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?)", rows)
+        self._wrote(len(rows))
+
+    # Look up a search key. Returns (found, track): found is False on a cache miss,
+    # and track is None when the key is a cached negative lookup.
+    def lookup(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT track_id, updated FROM searches WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return False, None
+        track_id, updated = row
+        if track_id is None:
+            return (now - updated <= self.negative_ttl), None
+        if now - updated > self.ttl:
+            return False, None
+        track = self.get_track(track_id)
+        return (track is not None), track
+
+    # Record a search result, pass track=None to store a negative lookup.
+    def put_search(self, key, track):
+        if track:
+            self.put_track(track)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                              (key, track['id'] if track else None, time.time()))
+        self._wrote(1)
+
+    # Drop expired entries, then the oldest ones until each table fits the size cap.
+    def prune(self):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM tracks WHERE updated < ?", (now - self.ttl,))
+            self.conn.execute("DELETE FROM searches WHERE updated < ? OR (track_id IS NULL AND updated < ?)",
+                              (now - self.ttl, now - self.negative_ttl))
+            for table, key in (("tracks", "track_id"), ("searches", "key")):
+                count = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                if count > self.max_entries:
+                    self.conn.execute(f"DELETE FROM {table} WHERE {key} IN "
+                                      f"(SELECT {key} FROM {table} ORDER BY updated LIMIT ?)",
+                                      (count - self.max_entries,))
+
+    def _wrote(self, count):
+        self.writes += count
+        if self.writes >= PRUNE_INTERVAL:
+            self.writes = 0
+            self.prune()
+
+
+# Use the shared Redis cache when REDIS_URL is set, otherwise the local SQLite file. A recording
+# run starts from an empty in-memory cache, so every search it makes is recorded, see replay.py.
+def open_track_cache():
+    if RECORDING:
+        return TrackCache(":memory:")
+    if os.getenv("REDIS_URL"):
+        from redis_backend import RedisTrackCache, get_redis
+        return RedisTrackCache(get_redis())
+    return TrackCache()
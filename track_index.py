@@ -0,0 +1,95 @@
+import difflib
+import os
+import re
+import threading
+import unicodedata
+
+# Normalized, fuzzy index of resolved tracks. LLM replies spell the same song in many ways:
+# case, punctuation, accents, "feat." credits, "- Remastered 2011" tags and stray whitespace.
+# canonical_key() folds those into one key, and TrackIndex also matches titles that are only
+# a typo away, so near-duplicate candidates resolve locally instead of searching Spotify again.
+FUZZY_THRESHOLD = float(os.getenv("FUZZY_MATCH_THRESHOLD", "0.9"))
+
+# Bracketed or dashed tags that name a release of a song rather than a different song
+VERSION_TAGS = r"remaster\w*|radio edit|single version|album version|mono|stereo|bonus track|deluxe\w*"
+BRACKETED = re.compile(r"[\(\[][^\)\]]*\b(?:feat|ft|featuring|with|" + VERSION_TAGS + r")\b[^\)\]]*[\)\]]")
+DASHED = re.compile(r"\s+-\s+[^-]*\b(?:" + VERSION_TAGS + r")\b.*$")
+FEATURING = re.compile(r"\s+(?:feat|ft|featuring)\b.*$")
+PUNCTUATION = re.compile(r"[^\w\s]|_")
+
+def _fold(text):
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    # Apostrophes are dropped rather than split on, so "Don't" and "Dont" agree
+    return text.casefold().replace("&", " and ").replace("'", "").replace("\u2019", "")
+
+def _clean(text):
+    return " ".join(PUNCTUATION.sub(" ", text).split())
+
+def normalize_title(title):
+    title = _fold(title)
+    title = BRACKETED.sub(" ", title)
+    title = DASHED.sub("", title)
+    title = FEATURING.sub("", title)
+    return _clean(title)
+
+# Explicit "feat." credits and a leading "the" are dropped. Commas are kept, since they are part
+# of names such as "Earth, Wind & Fire" or "Tyler, The Creator".
+def normalize_artist(artist):
+    artist = _clean(FEATURING.sub("", _fold(artist)))
+    return artist[4:] if artist.startswith("the ") else artist
+
+def canonical_key(title, artist):
+    return f"{normalize_title(title)}|{normalize_artist(artist)}"
+
+# Titles that differ in a number ("Song 2" and "Song 22") are different songs however similar
+def _similar(a, b, threshold):
+    if re.findall(r"\d+", a) != re.findall(r"\d+", b):
+        return False
+    return difflib.SequenceMatcher(None, a, b).ratio() >= threshold
+
+
+class TrackIndex:
+    def __init__(self, threshold=FUZZY_THRESHOLD):
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.keys = {}
+        # normalized artist -> {normalized title: track ID}
+        self.artists = {}
+
+    # Index a resolved track under the title and artist it was asked for, and under its
+    # Spotify name and lead artist when the track object is given.
+    def add(self, title, artist, track_id, track=None):
+        names = [(title, artist)]
+        if track:
+            names.append((track['name'], track['artists'][0]['name']))
+        with self.lock:
+            for name, artist_name in names:
+                normalized_title = normalize_title(name)
+                normalized_artist = normalize_artist(artist_name)
+                self.keys[f"{normalized_title}|{normalized_artist}"] = track_id
+                self.artists.setdefault(normalized_artist, {})[normalized_title] = track_id
+
+    # Return the track ID of an indexed song matching title and artist, or None.
+    def find(self, title, artist):
+        normalized_title = normalize_title(title)
+        normalized_artist = normalize_artist(artist)
+        with self.lock:
+            track_id = self.keys.get(f"{normalized_title}|{normalized_artist}")
+            if track_id or not normalized_title:
+                return track_id
+            if normalized_artist in self.artists:
+                candidates = [normalized_artist]
+            else:
+                candidates = difflib.get_close_matches(normalized_artist, list(self.artists), n=3, cutoff=self.threshold)
+            for candidate in candidates:
+                titles = self.artists[candidate]
+                if normalized_title in titles:
+                    return titles[normalized_title]
+                for indexed_title, track_id in titles.items():
+                    if _similar(normalized_title, indexed_title, self.threshold):
+                        return track_id
+        return None
+
+    def __len__(self):
+        return len(self.keys)
@@ -0,0 +1,57 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from replay import RECORDING
+
+# The Spotify profile used as prompt context is cached on disk and only refetched once it is
+# older than PROFILE_MAX_AGE, so starting a script with a fresh profile makes no network calls.
+PROFILE_PATH = os.getenv("USER_PROFILE_PATH", ".user_info.json")
+PROFILE_MAX_AGE = int(os.getenv("USER_PROFILE_MAX_AGE", str(24 * 60 * 60)))  # 1 day
+
+# A cached profile missing any of these was written by an older version and is fetched again
+PROFILE_KEYS = ("user", "top_ten_tracks", "top_ten_artists", "followed_artists", "saved_albums", "saved_tracks", "country")
+
+# Fetch the profile endpoints concurrently.
+def fetch_user_info(sp):
+    with ThreadPoolExecutor(max_workers=6) as pool:
+        user = pool.submit(sp.current_user)
+        top_ten_tracks = pool.submit(sp.current_user_top_tracks, limit=10)
+        top_ten_artists = pool.submit(sp.current_user_top_artists, limit=10)
+        followed_artists = pool.submit(sp.current_user_followed_artists, limit=10)
+        saved_albums = pool.submit(sp.current_user_saved_albums, limit=50)
+        saved_tracks = pool.submit(sp.current_user_saved_tracks, limit=50)
+    user = user.result()
+    return {
+        "user": user,
+        "top_ten_tracks": top_ten_tracks.result(),
+        "top_ten_artists": top_ten_artists.result(),
+        "followed_artists": followed_artists.result(),
+        "saved_albums": saved_albums.result(),
+        "saved_tracks": saved_tracks.result(),
+        "country": user['country']
+    }
+
+# Return the cached profile if it is fresh enough, otherwise fetch and cache it. A recording run
+# always fetches it, see replay.py.
+def load_user_info(sp, path=PROFILE_PATH, max_age=PROFILE_MAX_AGE):
+    if not RECORDING and os.path.exists(path) and time.time() - os.path.getmtime(path) < max_age:
+        try:
+            with open(path, encoding='utf-8') as f:
+                userInfo = json.load(f)
+            if all(key in userInfo for key in PROFILE_KEYS):
+                return userInfo
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable profile cache {path}: {e}")
+    userInfo = fetch_user_info(sp)
+    # Write to a temporary file first so a crash never leaves a half written cache
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        json.dump(userInfo, f)
+    os.replace(path + ".tmp", path)
+    return userInfo
+
+# Forget the Spotify login and cached profile, e.g. to switch accounts.
+def reset_login(token_cache=".cache", path=PROFILE_PATH):
+    for file in (token_cache, path):
+        if os.path.exists(file):
+            os.remove(file)